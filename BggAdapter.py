@@ -0,0 +1,150 @@
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+from random import uniform
+from time import monotonic, sleep, time
+from requests.exceptions import ConnectionError, Timeout
+from RateLimiter import RateLimitedAdapter
+from Metrics import metrics
+
+log = logging.getLogger(__name__)
+
+
+class CircuitOpenError(ConnectionError):
+    '''Raised instead of sending a request while BGG is down.'''
+
+
+class CircuitBreaker(object):
+    '''Counts failed requests. After threshold failures in a row the circuit opens and every
+    request fails at once for cooldown seconds. Then a single trial request is let through,
+    which closes the circuit if it works and opens it again if it doesn't.'''
+    def __init__(self, threshold=5, cooldown=30):
+        super(CircuitBreaker, self).__init__()
+        self._threshold = threshold
+        self._cooldown = cooldown
+        self._failures = 0
+        self._opened = None     # when the circuit opened, None while it is closed.
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        return self._opened is not None
+
+    def allow(self):
+        '''Return True if a request may be sent now.'''
+        with self._lock:
+            if self._opened is None:
+                return True
+            if self._trial or monotonic() - self._opened < self._cooldown:
+                return False
+            self._trial = True
+            return True
+
+    def success(self):
+        with self._lock:
+            if self._opened is not None:
+                log.info('BGG is answering again, closing the circuit.')
+            self._failures = 0
+            self._opened = None
+            self._trial = False
+
+    def abandon(self):
+        '''A request ended without telling us whether BGG is up. If it was the trial request,
+        wait out another cooldown before the next trial, rather than leaving the circuit open
+        for good.'''
+        with self._lock:
+            if self._trial:
+                self._trial = False
+                self._opened = monotonic()
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial or (self._opened is None and self._failures >= self._threshold):
+                log.warning('BGG failed {} times in a row, failing fast for {}s.'.format(
+                    self._failures, self._cooldown))
+                metrics.inc('r2d8_bgg_circuit_opened_total')
+                self._opened = monotonic()
+                self._trial = False
+
+
+class BggAdapter(RateLimitedAdapter):
+    '''Transport adapter for talking to BGG. On top of the rate limiting it sets separate
+    connect and read timeouts, retries throttled (429), failed (5xx) and timed out requests
+    with a jittered exponential backoff, and stops sending anything while breaker is open.
+    Mount one adapter on every BGG session so they all share its pool of keep-alive
+    connections.'''
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, limiter, breaker, timeout=(5, 20), retries=3, backoff=1, max_backoff=30,
+                 **kwargs):
+        '''timeout is (connect, read) in seconds. Failed requests are retried up to retries
+        times, waiting about backoff seconds, doubling each time up to max_backoff. Other
+        keyword arguments, e.g. pool_maxsize, are for HTTPAdapter.'''
+        self._breaker = breaker
+        self._timeout = timeout
+        self._retries = retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        super(BggAdapter, self).__init__(limiter, **kwargs)
+
+    def _delay(self, attempt, response=None):
+        '''Seconds to wait before retry number attempt, using the Retry-After header if BGG sent
+        one.'''
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                return min(self._max_backoff, float(retry_after))
+            except ValueError:
+                try:
+                    return min(self._max_backoff,
+                               max(0, parsedate_to_datetime(retry_after).timestamp() - time()))
+                except (TypeError, ValueError):
+                    pass
+
+        # full jitter, so threads that failed together don't all retry together.
+        return uniform(0, min(self._max_backoff, self._backoff * 2 ** attempt))
+
+    def send(self, request, **kwargs):
+        # the BGG client only takes a single timeout for both.
+        kwargs['timeout'] = self._timeout
+        attempt = 0
+        while True:
+            if not self._breaker.allow():
+                metrics.inc('r2d8_bgg_circuit_rejected_total')
+                raise CircuitOpenError('BGG is down, not asking for {}'.format(request.url),
+                                       request=request)
+
+            try:
+                response = super(BggAdapter, self).send(request, **kwargs)
+            except (ConnectionError, Timeout) as e:
+                self._breaker.failure()
+                if attempt >= self._retries:
+                    raise
+                log.info('BGG request failed: {}, retrying.'.format(e))
+                delay = self._delay(attempt)
+            except BaseException:
+                # every request has to settle the breaker, or a failed trial keeps it open.
+                self._breaker.abandon()
+                raise
+            else:
+                # being throttled means BGG is up, just busy.
+                if response.status_code == 429 or response.status_code not in self.RETRY_STATUSES:
+                    self._breaker.success()
+                else:
+                    self._breaker.failure()
+                if response.status_code not in self.RETRY_STATUSES:
+                    return response
+                if attempt >= self._retries:
+                    return response
+                log.info('BGG answered {}, retrying.'.format(response.status_code))
+                delay = self._delay(attempt, response)
+                response.close()
+
+            attempt += 1
+            metrics.inc('r2d8_bgg_retries_total')
+            sleep(delay)
+
+
+# shared by everything in the process talking to BGG, like bgg_limiter.
+bgg_breaker = CircuitBreaker()
@@ -1,12 +1,43 @@
 import sqlite3
 import logging
+import json
+import threading
+from collections import namedtuple
+from random import uniform
+from time import sleep, time
 
 log = logging.getLogger(__name__)
 
+# one bot command to run on an inbox item. id is the item's fullname, seq the command's
+# position in it.
+Job = namedtuple('Job', ['id', 'seq', 'command', 'subcommands', 'attempts', 'lease'])
+
 class BotDatabase(object):
+    # how long resolved names are trusted, in seconds. Names that resolved to nothing are
+    # retried sooner as new games show up on BGG all the time.
+    NAME_CACHE_TTL = 30 * 86400
+    NAME_CACHE_NEGATIVE_TTL = 86400
+    # max number of cached names. Least recently used names are dropped beyond this.
+    NAME_CACHE_SIZE = 50000
+    # how long the makeup of bot replies is kept for repairs, in seconds.
+    REPLY_TTL = 30 * 86400
+    # how long a worker has to finish a job before another worker may take it over, in seconds.
+    JOB_LEASE = 300
+    # failed jobs are retried after JOB_BACKOFF seconds, doubling each time up to JOB_MAX_BACKOFF.
+    # They are given up on after JOB_MAX_ATTEMPTS, which is a few hours of retrying.
+    JOB_BACKOFF = 30
+    JOB_MAX_BACKOFF = 1800
+    JOB_MAX_ATTEMPTS = 12
+
     def __init__(self, path):
         super(BotDatabase, self).__init__()
-        self._connection = sqlite3.connect(path)
+        # the connection is shared with the BGG lookup threads.
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        # let worker processes read while another one writes.
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._lock = threading.RLock()
+        self._aliases = None
+        self._aliases_version = None
 
         stmt = 'SELECT name FROM sqlite_master WHERE type="table" AND name="comments"'
         q = self._connection.execute(stmt).fetchall()
@@ -14,6 +45,15 @@ class BotDatabase(object):
             log.info('Creating comments table.')
             self._connection.execute('CREATE table comments (id text)')
 
+        stmt = 'SELECT name FROM sqlite_master WHERE type="index" AND name="comments_id"'
+        q = self._connection.execute(stmt).fetchall()
+        if not q:
+            # older databases have no index and may have the same comment more than once.
+            log.info('Indexing comments table.')
+            self._connection.execute('DELETE FROM comments WHERE rowid NOT IN '
+                                     '(SELECT MIN(rowid) FROM comments GROUP BY id)')
+            self._connection.execute('CREATE UNIQUE INDEX comments_id ON comments (id)')
+
         stmt = 'SELECT name FROM sqlite_master WHERE type="table" AND name="aliases"'
         q = self._connection.execute(stmt).fetchall()
         if not q:
@@ -49,40 +89,127 @@ class BotDatabase(object):
             log.info('Created ignore table.')
             pass
 
+        stmt = 'SELECT name FROM sqlite_master WHERE type="table" AND name="name_cache"'
+        q = self._connection.execute(stmt).fetchall()
+        if not q:
+            log.info('Creating name_cache table.')
+            # game_id is NULL for names that BGG knows nothing about.
+            self._connection.execute('CREATE table name_cache (name text PRIMARY KEY, game_id integer, '
+                                     'updated real, used real)')
+            self._connection.execute('CREATE INDEX name_cache_used ON name_cache (used)')
+
+        stmt = 'SELECT name FROM sqlite_master WHERE type="table" AND name="jobs"'
+        q = self._connection.execute(stmt).fetchall()
+        if not q:
+            log.info('Creating jobs table.')
+            # state is pending, running, done or failed. lease is the worker that has a running
+            # job, until lease_expires. reply_id is set once the job's reply is posted.
+            self._connection.execute('CREATE table jobs (id text, seq integer, command text, '
+                                     'subcommands text, state text, attempts integer, '
+                                     'next_retry real, lease text, lease_expires real, '
+                                     'reply_id text, error text, updated real, '
+                                     'PRIMARY KEY (id, seq))')
+            self._connection.execute('CREATE INDEX jobs_state ON jobs (state, next_retry)')
+
+        stmt = 'SELECT name FROM sqlite_master WHERE type="table" AND name="replies"'
+        q = self._connection.execute(stmt).fetchall()
+        if not q:
+            log.info('Creating replies table.')
+            self._connection.execute('CREATE table replies (id text PRIMARY KEY, record text, updated real)')
+
         self._connection.commit()
+        self._name_inserts = 0
+        self._reply_inserts = 0
+        self._job_finishes = 0
+        self._held = dict()     # (id, seq): lease of the jobs claimed and not yet finished.
+        self._renewer = None
 
     def add_comment(self, comment):
         log.debug('adding comment {} to database'.format(comment.id))
         comment.mark_read()
-        self._connection.execute('INSERT INTO comments VALUES(?)', (comment.id,))
-        self._connection.commit()
+        with self._lock:
+            self._connection.execute('INSERT OR IGNORE INTO comments VALUES(?)', (comment.id,))
+            self._connection.commit()
+
+    def add_comments(self, comments, inbox):
+        '''Add many comments at once, marking them read in a single call to inbox, the bot's
+        reddit inbox.'''
+        if not comments:
+            return
+
+        log.debug('adding comments {} to database'.format(', '.join(c.id for c in comments)))
+        inbox.mark_read(comments)
+        with self._lock:
+            self._connection.executemany('INSERT OR IGNORE INTO comments VALUES(?)',
+                                         [(c.id,) for c in comments])
+            self._connection.commit()
 
     def remove_comment(self, comment):
         log.debug('removing comment {} from database'.format(comment.id))
         comment.mark_unread()
-        self._connection.execute('DELETE FROM comments WHERE id = (?)', (comment.id,))
-        self._connection.commit()
+        with self._lock:
+            self._connection.execute('DELETE FROM comments WHERE id = (?)', (comment.id,))
+            self._connection.commit()
 
     def comment_exists(self, comment):
         cmd = 'SELECT COUNT(*) FROM comments WHERE id=?'
         count = self._connection.execute(cmd, (comment.id,)).fetchall()[0]
         return count and count[0] > 0
 
+    # sqlite allows at most 999 parameters in one statement.
+    MAX_QUERY_PARAMS = 500
+
+    def new_comments(self, comments):
+        '''Return the comments that are not in the database, in the order given.'''
+        ids = list({c.id for c in comments})
+        known = set()
+        for start in range(0, len(ids), self.MAX_QUERY_PARAMS):
+            chunk = ids[start:start + self.MAX_QUERY_PARAMS]
+            cmd = 'SELECT id FROM comments WHERE id IN ({})'.format(','.join('?' * len(chunk)))
+            known.update(row[0] for row in self._connection.execute(cmd, chunk).fetchall())
+
+        new = dict()
+        for c in comments:
+            if c.id not in known and c.id not in new:
+                new[c.id] = c
+
+        return list(new.values())
+
+    def _alias_map(self):
+        '''The aliases as a dict of alias: gamename. Kept in memory and only re-read from the
+        database when another connection has changed it.'''
+        with self._lock:
+            version = self._connection.execute('PRAGMA data_version').fetchone()[0]
+            if self._aliases is None or version != self._aliases_version:
+                log.debug('loading aliases from database')
+                aliases = dict()
+                for gamename, alias in self._connection.execute('SELECT gamename, alias FROM aliases'):
+                    aliases.setdefault(alias, gamename)
+                self._aliases = aliases
+                self._aliases_version = version
+
+            return self._aliases
+
     def add_alias(self, alias, name):
         gname = self.get_name_from_alias(alias)
         if not gname:
-            self._connection.execute('INSERT INTO aliases VALUES (?, ?)', (name, alias))
-            self._connection.commit()
+            with self._lock:
+                self._connection.execute('INSERT INTO aliases VALUES (?, ?)', (name, alias))
+                self._connection.commit()
+                # our own writes don't change data_version, so keep the map up to date here.
+                self._alias_map()[alias] = name
 
     def get_name_from_alias(self, name):
-        cmd = 'SELECT gamename FROM aliases where alias=?'
-        rows = self._connection.execute(cmd, (name,)).fetchall()
-        return rows[0][0] if rows else None
+        return self._alias_map().get(name)
+
+    def get_names_from_aliases(self, names):
+        '''Resolve a list of names, returning the real name for aliases and the name itself
+        otherwise.'''
+        aliases = self._alias_map()
+        return [aliases.get(name, name) for name in names]
 
     def aliases(self):
-        cmd = 'SELECT * FROM aliases' 
-        rows = self._connection.execute(cmd).fetchall()
-        return [] if not rows else rows
+        return [(gamename, alias) for alias, gamename in self._alias_map().items()]
 
     def is_admin(self, uid):
         cmd = 'SELECT COUNT(ruid) FROM bot_admins where ruid=?'
@@ -99,3 +226,190 @@ class BotDatabase(object):
             return False
 
         return False if rows[0][0] == 0 else True
+
+    def lookup_name(self, name):
+        '''Look up a game name in the name cache. Returns (found, game_id). game_id is None
+        for names that are known to not be games.'''
+        with self._lock:
+            cmd = 'SELECT game_id, updated FROM name_cache WHERE name=?'
+            rows = self._connection.execute(cmd, (name,)).fetchall()
+            if not rows:
+                return False, None
+
+            game_id, updated = rows[0]
+            ttl = self.NAME_CACHE_TTL if game_id is not None else self.NAME_CACHE_NEGATIVE_TTL
+            if updated + ttl < time():
+                return False, None
+
+            self._connection.execute('UPDATE name_cache SET used=? WHERE name=?', (time(), name))
+            self._connection.commit()
+            return True, game_id
+
+    def cache_name(self, name, game_id):
+        '''Remember what a game name resolved to. Use None for names that are not games.'''
+        with self._lock:
+            now = time()
+            self._connection.execute('INSERT OR REPLACE INTO name_cache VALUES (?, ?, ?, ?)',
+                                     (name, game_id, now, now))
+            # only check the size now and again, it's a table scan.
+            self._name_inserts += 1
+            if self._name_inserts % 100 == 0:
+                cmd = ('DELETE FROM name_cache WHERE name IN (SELECT name FROM name_cache '
+                       'ORDER BY used DESC LIMIT -1 OFFSET ?)')
+                self._connection.execute(cmd, (self.NAME_CACHE_SIZE,))
+            self._connection.commit()
+
+    def save_reply(self, reply_id, record):
+        '''Remember the blocks a bot reply was built from, see CommentHandler._getInfoReply.'''
+        with self._lock:
+            self._connection.execute('INSERT OR REPLACE INTO replies VALUES (?, ?, ?)',
+                                     (reply_id, json.dumps(record), time()))
+            self._reply_inserts += 1
+            if self._reply_inserts % 100 == 0:
+                self._connection.execute('DELETE FROM replies WHERE updated < ?',
+                                         (time() - self.REPLY_TTL,))
+            self._connection.commit()
+
+    def get_reply(self, reply_id):
+        '''The record saved for a bot reply, or None.'''
+        cmd = 'SELECT record FROM replies WHERE id=?'
+        rows = self._connection.execute(cmd, (reply_id,)).fetchall()
+        return json.loads(rows[0][0]) if rows else None
+
+    def add_jobs(self, jobs):
+        '''Queue bot commands to run. jobs is a list of (fullname, commands) where commands
+        is a list of (command, subcommands) found in the item. Items already queued are left
+        alone, so polling the same item twice doesn't run it twice.'''
+        now = time()
+        rows = [(fullname, seq, command, subcommands.strip(), 'pending', 0, now, None, None,
+                 None, None, now)
+                for fullname, commands in jobs
+                for seq, (command, subcommands) in enumerate(commands)]
+        if not rows:
+            return
+
+        with self._lock:
+            self._connection.executemany('INSERT OR IGNORE INTO jobs VALUES '
+                                         '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self._connection.commit()
+
+    def claim_jobs(self, worker, limit=1):
+        '''Lease up to limit jobs that are due to run to worker, oldest first. Jobs whose
+        worker died, i.e. whose lease ran out, are due too.'''
+        now = time()
+        # unique to this claim, so we get back exactly the jobs this call leased.
+        lease = '{}@{}'.format(worker, now)
+        with self._lock:
+            # a single UPDATE, so no other process can lease the same jobs in between.
+            self._connection.execute(
+                'UPDATE jobs SET state="running", lease=?, lease_expires=?, attempts=attempts+1, '
+                'updated=? WHERE rowid IN (SELECT rowid FROM jobs WHERE (state="pending" AND '
+                'next_retry<=?) OR (state="running" AND lease_expires<?) '
+                'ORDER BY next_retry LIMIT ?)',
+                (lease, now + self.JOB_LEASE, now, now, now, limit))
+            self._connection.commit()
+            cmd = ('SELECT id, seq, command, subcommands, attempts, lease FROM jobs WHERE lease=? '
+                   'ORDER BY next_retry')
+            jobs = [Job(*row) for row in self._connection.execute(cmd, (lease,)).fetchall()]
+            for job in jobs:
+                self._held[(job.id, job.seq)] = job.lease
+            if jobs and self._renewer is None:
+                self._renewer = threading.Thread(target=self._renew_leases, name='leases',
+                                                 daemon=True)
+                self._renewer.start()
+            return jobs
+
+    def _renew_leases(self):
+        '''Keep extending the leases on the jobs this process holds, so a job that runs or waits
+        to be posted for longer than JOB_LEASE isn't taken to be abandoned and run again.'''
+        while True:
+            sleep(self.JOB_LEASE / 3)
+            try:
+                with self._lock:
+                    expires = time() + self.JOB_LEASE
+                    self._connection.executemany(
+                        'UPDATE jobs SET lease_expires=? WHERE id=? AND seq=? AND lease=?',
+                        [(expires, id, seq, lease) for (id, seq), lease in self._held.items()])
+                    self._connection.commit()
+            except Exception as e:
+                log.error('Caught exception renewing job leases: {}'.format(e))
+
+    def _release(self, job, cmd, args):
+        '''Run cmd, an UPDATE of job, if this worker still holds its lease. Returns False if it
+        doesn't, i.e. the lease ran out and another worker has taken the job over.'''
+        self._held.pop((job.id, job.seq), None)
+        cur = self._connection.execute(cmd + ' WHERE id=? AND seq=? AND lease=?',
+                                       args + (job.id, job.seq, job.lease))
+        if not cur.rowcount:
+            log.warning('lost the lease on {} {}, leaving it to its new worker'.format(
+                job.id, job.command))
+        return cur.rowcount > 0
+
+    def finish_job(self, job):
+        '''Mark job done. Returns False if this worker no longer held it.'''
+        with self._lock:
+            finished = self._release(job, 'UPDATE jobs SET state="done", lease=NULL, updated=?',
+                                     (time(),))
+            self._job_finishes += 1
+            if self._job_finishes % 100 == 0:
+                self._connection.execute('DELETE FROM jobs WHERE state="done" AND updated < ?',
+                                         (time() - self.REPLY_TTL,))
+            self._connection.commit()
+            return finished
+
+    def retry_job(self, job, error, permanent=False):
+        '''Put a failed job back in the queue, to run again after a backoff. Gives up on it
+        after JOB_MAX_ATTEMPTS, or straight away if the error is permanent.'''
+        now = time()
+        if permanent:
+            log.error('giving up on {} {}: {}'.format(job.id, job.command, error))
+            state, next_retry = 'failed', now
+        elif job.attempts >= self.JOB_MAX_ATTEMPTS:
+            log.error('giving up on {} {} after {} attempts: {}'.format(
+                job.id, job.command, job.attempts, error))
+            state, next_retry = 'failed', now
+        else:
+            # jitter, so jobs that failed together don't all retry together.
+            backoff = min(self.JOB_MAX_BACKOFF, self.JOB_BACKOFF * 2 ** (job.attempts - 1))
+            state, next_retry = 'pending', now + backoff * uniform(0.5, 1)
+            log.info('retrying {} {} in {:.0f}s'.format(job.id, job.command, next_retry - now))
+
+        with self._lock:
+            self._release(job, 'UPDATE jobs SET state=?, next_retry=?, lease=NULL, error=?, '
+                          'updated=?', (state, next_retry, str(error), now))
+            self._connection.commit()
+
+    def retry_now(self):
+        '''Make jobs waiting out a backoff due now. Used once a retry works, as then whatever
+        they failed on has probably recovered and the backlog can drain at full speed.'''
+        with self._lock:
+            cur = self._connection.execute('UPDATE jobs SET next_retry=? WHERE state="pending" AND '
+                                           'next_retry>?', (time(), time()))
+            self._connection.commit()
+            return cur.rowcount
+
+    def job_may_reply(self, job):
+        '''Check, just before posting job's reply, that this worker still holds its lease and
+        the reply hasn't been recorded. Only one worker holds a lease at a time, so no two
+        attempts at a job both get to post.'''
+        cmd = ('SELECT COUNT(*) FROM jobs WHERE id=? AND seq=? AND lease=? AND state="running" '
+               'AND reply_id IS NULL')
+        with self._lock:
+            return self._connection.execute(cmd, (job.id, job.seq, job.lease)).fetchone()[0] > 0
+
+    def job_replied(self, job, reply_id):
+        '''Record that the job's reply has been posted, so a retry doesn't post it again.'''
+        with self._lock:
+            self._connection.execute('UPDATE jobs SET reply_id=? WHERE id=? AND seq=? AND lease=?',
+                                     (reply_id, job.id, job.seq, job.lease))
+            self._connection.commit()
+
+    def job_replies(self, fullname):
+        '''The reply ids recorded for the jobs on an item, by seq.'''
+        cmd = 'SELECT seq, reply_id FROM jobs WHERE id=? AND reply_id IS NOT NULL'
+        return dict(self._connection.execute(cmd, (fullname,)).fetchall())
+
+    def job_counts(self):
+        '''Number of jobs in each state.'''
+        cmd = 'SELECT state, COUNT(*) FROM jobs GROUP BY state'
+        return dict(self._connection.execute(cmd).fetchall())
@@ -2,30 +2,247 @@
 # -*- coding: utf-8
 
 import logging
-import re
-from time import sleep
+import sqlite3
+import threading
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import quote, unquote
 from random import choice
 from os import getcwd
 from os.path import join as pjoin
-from boardgamegeek import BoardGameGeek as BGG
-from boardgamegeek.api import BoardGameGeekNetworkAPI
-import boardgamegeek
-import praw
+from GameCache import GameCache
+from GameRecord import GameRecord
+from Prefetcher import Prefetcher
+from RenderCache import RenderCache
+from SingleFlight import SingleFlight
+import CommentParser
+from Metrics import metrics
 
 log = logging.getLogger(__name__)
 
 
+# praw, boardgamegeek and requests are slow to import, so they are only imported when first
+# needed. Runs that never talk to BGG don't pay for them at all.
+def _bgg_error():
+    '''The exception boardgamegeek's client raises.'''
+    from boardgamegeek.exceptions import BoardGameGeekError
+    return BoardGameGeekError
+
+
 class CommentHandler(object):
-    def __init__(self, UID, botdb):
+    # max number of BGG lookups run at the same time for a single request.
+    DEFAULT_LOOKUP_THREADS = 8
+    # max number of games asked for in a single BGG thing request.
+    BGG_BATCH_SIZE = 20
+    # max number of search hits looked at when ranking a sloppy search.
+    SEARCH_CANDIDATE_LIMIT = 40
+    # seconds BGG data is kept, both in the sqlite cache and in memory.
+    BGG_CACHE_TTL = 86400
+    # seconds an expired game is still shown while it's being refreshed in the background.
+    STALE_GRACE = 3600
+    # seconds to wait for BGG to accept a connection and to send a response.
+    BGG_CONNECT_TIMEOUT = 5
+    BGG_READ_TIMEOUT = 20
+
+    def __init__(self, UID, botdb, lookup_threads=DEFAULT_LOOKUP_THREADS,
+                 game_cache_size=GameCache.DEFAULT_SIZE, bgg=None, catalogue=None,
+                 game_cache_file=None, prefetch=False,
+                 bgg_timeout=(BGG_CONNECT_TIMEOUT, BGG_READ_TIMEOUT), shared_bgg=False,
+                 bgg_error=None):
+        '''bgg is the BGG client to use. By default one is made with a sqlite cache in the
+        current directory, with bgg_timeout as its (connect, read) timeouts. shared_bgg says
+        other bot processes use that cache too, so they also share its BGG rate limit.
+        bgg_error is the exception bgg raises, by default boardgamegeek's. catalogue is an
+        optional GameCatalogue used to find game names without asking BGG. game_cache_file is
+        where the in memory game cache is kept between runs. prefetch starts a background
+        thread that keeps popular games fresh.'''
         self._botdb = botdb
+        self._catalogue = catalogue
         self._botname = UID
         self._header = ('^*[{}](/r/r2d8)* ^*issues* ^*a* ^*series* ^*of* ^*sophisticated* '
                         '^*bleeps* ^*and* ^*whistles...*\n\n'.format(self._botname))
         self._footer = ''
 
-        dbpath = pjoin(getcwd(), '{}-bgg.db'.format(self._botname))
-        self._bgg = BGG(cache='sqlite://{}?ttl=86400'.format(dbpath))
+        # the BGG clients are made on first use, see _bggClients.
+        self._bggClient = bgg
+        self._refreshBggClient = bgg
+        self._bggLock = threading.Lock()
+        self._bggTimeout = bgg_timeout
+        self._sharedBgg = shared_bgg
+        self._bggErrorClass = bgg_error
+        self._lookupThreads = max(1, lookup_threads)
+        # parsed games, so popular games skip the sqlite read and XML parsing.
+        self._gameCache = GameCache(game_cache_size, self.BGG_CACHE_TTL,
+                                    self.STALE_GRACE if prefetch else 0)
+        self._gameCacheFile = game_cache_file
+        if game_cache_file:
+            self._gameCache.load(game_cache_file)
+        if prefetch:
+            Prefetcher(self._gameCache, self._bggRefreshGames, batch_size=self.BGG_BATCH_SIZE).start()
+        metrics.add_collector(lambda: {'r2d8_game_cache_' + k: v for k, v in self.cacheStats().items()})
+        # rendered markdown for each game, as the same popular games are shown over and over.
+        self._renderCache = RenderCache()
+        metrics.add_collector(lambda: {'r2d8_render_cache_' + k: v
+                                       for k, v in self._renderCache.stats().items()})
+        # lookups for a name or game that is already being looked up wait for that lookup, so a
+        # busy thread asking about the same game doesn't send BGG the same requests many times.
+        self._nameFlights = SingleFlight('name')
+        self._idFlights = SingleFlight('id')
+        self._lookupPool = ThreadPoolExecutor(max_workers=self._lookupThreads,
+                                              thread_name_prefix='bgg-lookup')
+        # getthreadinfo looks up a lot of names, so it gets a pool of its own rather than
+        # making everyone else's lookups queue behind its.
+        self._threadLookupPool = ThreadPoolExecutor(max_workers=self.THREAD_LOOKUP_THREADS,
+                                                    thread_name_prefix='bgg-thread-lookup')
+        # all replies, edits and messages go through these so the main loop can choose how they get posted.
+        self.replier = self._postReply
+        self.editor = self._postEdit
+        self.messenger = self._postMessage
+        # the job each thread is running, see BotDatabase.claim_jobs.
+        self._job = threading.local()
+
+    def _bggClients(self):
+        '''Make the default BGG clients: one with a sqlite cache in the current directory and
+        an uncached one for refreshes.'''
+        with self._bggLock:
+            if self._bggClient:
+                return
+
+            from boardgamegeek import BoardGameGeek as BGG
+            from BggAdapter import BggAdapter, bgg_breaker
+            from RateLimiter import BGG_BURST, BGG_REQUESTS_PER_SECOND, SharedRateLimiter, bgg_limiter
+            dbpath = pjoin(getcwd(), '{}-bgg.db'.format(self._botname))
+            # several bot processes may share the cache, WAL lets them read while one writes.
+            with closing(sqlite3.connect(dbpath)) as db:
+                db.execute('PRAGMA journal_mode=WAL')
+            # processes sharing the cache keep to one rate limit between them.
+            limiter = (SharedRateLimiter(dbpath, 'bgg', BGG_REQUESTS_PER_SECOND, BGG_BURST)
+                       if self._sharedBgg else bgg_limiter)
+            bgg = BGG(cache='sqlite://{}?ttl={}'.format(dbpath, self.BGG_CACHE_TTL),
+                      timeout=self._bggTimeout[1])
+            # refreshes must skip the sqlite cache, it has the same stale data.
+            refreshBgg = BGG(cache=None, timeout=self._bggTimeout[1])
+            # both clients share one adapter, and so one pool of keep-alive connections, big
+            # enough for every lookup thread and the prefetcher. The adapter spaces requests
+            # out so BGG doesn't throttle us, retries failures and fails fast while BGG is down.
+            adapter = BggAdapter(limiter, bgg_breaker, timeout=self._bggTimeout,
+                                 pool_maxsize=self._lookupThreads + 1)
+            for client in (bgg, refreshBgg):
+                for prefix in ('http://', 'https://'):
+                    client.requests_session.mount(prefix, adapter)
+            metrics.add_collector(lambda: {'r2d8_bgg_circuit_open': int(bgg_breaker.is_open())})
+            self._refreshBggClient = refreshBgg
+            self._bggClient = bgg
+
+    def bggError(self):
+        '''The exception the BGG client raises.'''
+        return self._bggErrorClass or _bgg_error()
+
+    @property
+    def _bgg(self):
+        if not self._bggClient:
+            self._bggClients()
+        return self._bggClient
+
+    @property
+    def _refreshBgg(self):
+        if not self._refreshBggClient:
+            self._bggClients()
+        return self._refreshBggClient
+
+    def setJob(self, job):
+        '''Set the job the commands run in this thread are for, or None.'''
+        self._job.current = job
+
+    def currentJob(self):
+        return getattr(self._job, 'current', None)
+
+    def _postReply(self, target, body, record=None, job=None):
+        '''Reply to target. record is what the reply was built from, see _getInfoReply. job is
+        the job the reply is for, by default the one running in this thread.'''
+        job = job or self.currentJob()
+        if job and not self._botdb.job_may_reply(job):
+            log.info('{} is answered or taken over by another worker, not replying'.format(job.id))
+            return
+        if job and job.attempts > 1 and self._alreadyReplied(target, job):
+            log.info('Already replied to {} for {}, not replying again'.format(target.id, job.id))
+            return
+
+        with metrics.timer('r2d8_reply_seconds'):
+            reply = target.reply(body)
+        if job and reply:
+            self._botdb.job_replied(job, reply.id)
+        if record and reply:
+            self._botdb.save_reply(reply.id, record)
+
+    def _postEdit(self, target, body, record=None, job=None):
+        '''Replace the text of the bot's comment target. record is what the new text was built
+        from, see _getInfoReply.'''
+        with metrics.timer('r2d8_edit_seconds'):
+            target.edit(body)
+        if record:
+            self._botdb.save_reply(target.id, record)
+
+    def _postMessage(self, target, body, subject, job=None):
+        '''Send a private message to the redditor target.'''
+        with metrics.timer('r2d8_message_seconds'):
+            target.message(subject, body)
+
+    def _alreadyReplied(self, target, job):
+        '''Check if an earlier attempt at job already replied to target.'''
+        replied = self._botdb.job_replies(job.id)
+        if job.seq in replied:
+            return True
+
+        # the last attempt may have died between posting and recording the reply, so look for a
+        # bot reply that isn't for one of the item's other commands.
+        if hasattr(target, 'refresh'):
+            target.refresh()
+        others = set(replied.values())
+        return any(getattr(r, 'author', None) and r.author.name == self._botname
+                   and r.id not in others for r in target.replies)
+
+    def _gameIdFromName(self, name):
+        '''Return the BGG ID if name is of the form '#1234', else None.'''
+        m = CommentParser.GAME_ID_REGEX.search(name.strip())
+        return int(m.group(1)) if m else None
+
+    def _bggFetchGames(self, game_ids, request=True, stats=True):
+        '''Get many games by ID using as few BGG requests as possible. Returns a dict of id: game.
+        request and stats are as for GameCache.get.'''
+        games = dict()
+        missing = list()
+        for game_id in dict.fromkeys(game_ids):
+            game = self._gameCache.get(game_id, request, stats)
+            if game:
+                games[game_id] = game
+            else:
+                missing.append(game_id)
+
+        if missing:
+            games.update((game_id, game) for game_id, game
+                         in self._idFlights.do_many(missing, self._bggFetchMissing).items() if game)
+        return games
+
+    def _bggFetchMissing(self, missing):
+        '''Ask BGG for the games, BGG_BATCH_SIZE at a time. Returns a dict of id: game.'''
+        games = dict()
+        for start in range(0, len(missing), self.BGG_BATCH_SIZE):
+            chunk = missing[start:start + self.BGG_BATCH_SIZE]
+            log.debug('asking BGG for games {}'.format(chunk))
+            metrics.inc('r2d8_bgg_calls_total', call='game_list')
+            with metrics.timer('r2d8_bgg_fetch_seconds'):
+                chunk_games = [GameRecord.from_game(g) for g in self._bgg.game_list(game_id_list=chunk)]
+            for game in chunk_games:
+                self._gameCache.put(game)
+                games[game.id] = game
+
+        return games
+
+    def _bggRefreshGames(self, game_ids):
+        '''Get fresh copies of games straight from BGG, for the Prefetcher.'''
+        metrics.inc('r2d8_bgg_calls_total', call='refresh')
+        return [GameRecord.from_game(g) for g in self._refreshBgg.game_list(game_id_list=game_ids)]
 
     def _bggQueryGame(self, name):
         '''Try "name", then if not found try a few other small things in an effort to find it.'''
@@ -37,96 +254,166 @@ class CommentHandler(object):
             log.warn('Got too long game name: {}'.format(name))
             return None
 
+        return self._nameFlights.do(name, self._bggLookupName, name)
+
+    def _bggLookupName(self, name):
+        '''Find the game for the already cleaned up name.'''
         # Search IDs when name format is '#1234'
-        if re.search('^#(\d+)$', name):  
-            game = self._bgg.game(name=None, game_id=name[1:])
+        game_id = self._gameIdFromName(name)
+        if game_id is not None:
+            game = self._bggFetchGames([game_id]).get(game_id)
             if game:
                 log.debug('found game {} via searching by ID'.format(name))
                 return game
 
-        game = self._bgg.game(name)
+        game = self._gameCache.get_by_name(name)
         if game:
             return game
 
+        # we may have seen this name before, if so skip all the guessing below.
+        found, game_id = self._botdb.lookup_name(name)
+        metrics.inc('r2d8_name_cache_total', result='hit' if found else 'miss')
+        if found:
+            log.debug('name cache has {} as {}'.format(name, game_id))
+            if game_id is None:
+                return None
+            # get_by_name has already counted this lookup's miss.
+            game = self._bggFetchGames([game_id], stats=False).get(game_id)
+            if game:
+                self._gameCache.put(game, [name])
+                return game
+
+        game = None
+        if self._catalogue:
+            game_id = self._catalogue.resolve(name, fuzzy=False)
+            metrics.inc('r2d8_catalogue_total', result='hit' if game_id else 'miss')
+            if game_id:
+                game = self._bggFetchGames([game_id], stats=False).get(game_id)
+
+        if not game:
+            game = self._bggGame(name, 'name')
+
+        # a close match in the catalogue is only a guess, and a game newer than the catalogue
+        # would always get the older game it looks like. So it comes after asking BGG for the
+        # exact name, and isn't kept in the name cache.
+        guessed = False
+        if not game and self._catalogue:
+            game_id = self._catalogue.resolve(name)
+            if game_id:
+                metrics.inc('r2d8_catalogue_total', result='fuzzy')
+                game = self._bggFetchGames([game_id], stats=False).get(game_id)
+                guessed = game is not None
+
+        if not game:
+            game = self._bggResolveName(name)
+        if not guessed:
+            self._botdb.cache_name(name, game.id if game else None)
+        if game:
+            self._gameCache.put(game, [name])
+        return game
+
+    def cacheStats(self):
+        '''Hit/miss counts for the in memory game cache.'''
+        return self._gameCache.stats()
+
+    def saveGameCache(self):
+        if self._gameCacheFile:
+            self._gameCache.save(self._gameCacheFile)
+
+    def _bggGame(self, name, step):
+        '''Ask BGG for the game called name, timed as the given step of the fallback chain.'''
+        metrics.inc('r2d8_bgg_calls_total', call='game')
+        with metrics.timer('r2d8_bgg_lookup_seconds', step=step):
+            game = self._bgg.game(name)
+        return GameRecord.from_game(game) if game else None
+
+    def _bggResolveName(self, name):
+        '''Work through the variations of name until BGG finds a game. name itself has already
+        been tried.'''
         # embedded url? If so, extract.
         log.debug('Looking for embedded URL')
-        m = re.search('\[([^]]*)\]', name)
+        m = CommentParser.EMBEDDED_URL_REGEX.search(name)
         if m:
             name = m.group(1)
-            game = self._bgg.game(name)
+            game = self._bggGame(name, 'embedded')
             if game:
                 return game
 
         # note: unembedded from here down
         # remove 'the's
         log.debug('removing "the"s')
-        tmpname = re.sub('^the ', '', name)
-        tmpname = re.sub('\sthe\s', ' ', tmpname)
+        tmpname = CommentParser.LEADING_THE_REGEX.sub('', name)
+        tmpname = CommentParser.INNER_THE_REGEX.sub(' ', tmpname)
         if tmpname != name:
-            game = self._bgg.game(tmpname)
+            game = self._bggGame(tmpname, 'strip_the')
             if game:
                 return game
 
         # add a "the" at start.
         log.debug('adding "the" at start')
-        game = self._bgg.game('The ' + name)
+        game = self._bggGame('The ' + name, 'add_the')
         if game:
             return game
 
         # various substistutions.
-        subs = [
-            ('[?!.:,]*', '', 'removing punctuation'),
-            ('\sand\s', ' & ', 'and --> &'),
-            ('\s&\s', ' and ', '& --> and')
-        ]
-        for search, sub, logmess in subs:
+        for search, sub, logmess, step in CommentParser.NAME_SUBSTITUTIONS:
             log.debug(logmess)
-            tmpname = re.sub(search, sub, name)
+            tmpname = search.sub(sub, name)
             if tmpname != name:
-                game = self._bgg.game(tmpname)
+                game = self._bggGame(tmpname, step)
                 if game:
                     return game
 
         # well OK - let's pull out the heavy guns and use the search API.
         # this will give us a bunch of things to sort through, but hopefully
         # find something.
-        return self._bggSearchGame(name)
+        with metrics.timer('r2d8_bgg_lookup_seconds', step='search'):
+            return self._bggSearchGame(name)
 
     def _bggSearchGame(self, name):
         '''Use the much wider search API to find the game.'''
-        items = self._bgg.search(name, search_type=BoardGameGeekNetworkAPI.SEARCH_BOARD_GAME, exact=True)
+        metrics.inc('r2d8_bgg_calls_total', call='search')
+        items = self._bgg.search(name, search_type=self._bgg.SEARCH_BOARD_GAME, exact=True)
         if items and len(items) == 1:
             log.debug('Found exact match using search().')
-            return self._bgg.game(items[0].name)
+            return self._bggGame(items[0].name, 'search_hit')
 
         # exact match not found, trying sloppy match
-        items = self._bgg.search(name, search_type=BoardGameGeekNetworkAPI.SEARCH_BOARD_GAME)
+        metrics.inc('r2d8_bgg_calls_total', call='search')
+        items = self._bgg.search(name, search_type=self._bgg.SEARCH_BOARD_GAME)
         if items and not len(items):
             log.debug('Found no matches at all using search().')
             return None
 
         if items and len(items) == 1:
             log.debug('Found one match usinh search().')
-            return self._bgg.game(items[0].name)
+            return self._bggGame(items[0].name, 'search_hit')
 
         if not items:
             return None
 
         # assume most owned is what people want. Is this good? Dunno.
+        # Candidates are fetched in batches in search order, stopping once a batch turns up
+        # a game with exactly the name asked for.
+        candidates = [i.id for i in items if getattr(i, 'type', None) != 'boardgameexpansion']
+        candidates = candidates[:self.SEARCH_CANDIDATE_LIMIT]
         most_owned = None
-        for i in items:
-            game = self._bgg.game(None, game_id=i.id)
-            # GTL the lib throws an uncaught exception if BGG assessed too quickly.
-            # GTL - this needs to be fixed in the library.
-            sleep(1)
-            if getattr(game, 'expansion', False):
-                log.debug('ignoring expansion')
-                continue
-            else:
-                if not most_owned:
+        for start in range(0, len(candidates), self.BGG_BATCH_SIZE):
+            exact = False
+            # nobody asked for the candidates, so they don't count towards what's popular.
+            batch = candidates[start:start + self.BGG_BATCH_SIZE]
+            for game in self._bggFetchGames(batch, request=False, stats=False).values():
+                if getattr(game, 'expansion', False):
+                    log.debug('ignoring expansion')
+                    continue
+
+                if not most_owned or getattr(game, 'users_owned', 0) > most_owned.users_owned:
                     most_owned = game
-                else:
-                    most_owned = game if getattr(game, 'owned', 0) > most_owned.owned else most_owned
+                exact = exact or game.name.lower() == name
+
+            if exact:
+                log.debug('found exact name match, not looking at more search hits.')
+                break
 
         if most_owned:
             return most_owned
@@ -142,30 +429,59 @@ class CommentHandler(object):
         # TODO
     }
 
-    def _findGames(self, items, sort='name'):
+    def _findGames(self, items, sort='name', pool=None):
+        '''Look up the games named in items on pool, by default the shared lookup pool. Returns
+        [games found, names not found].'''
+        pool = pool or self._lookupPool
         # convert aliases to real names. It may be better to do this after we don't find the
         # game. Oh, well.
         #   I think this might be better behavior, since it makes it easy to
         #   replace findable-but-unlikely results with the more popular result
         #   that was probably intended. -TDHS
-        for i in range(len(items)):
-            real_name = self._botdb.get_name_from_alias(items[i])
-            if real_name:
-                items[i] = real_name
+        items = self._botdb.get_names_from_aliases(items)
 
-        # filter out dups.
-        items = list(set(items))
-        items = [unquote(b) for b in items]
+        # filter out dups, keeping the order they were asked for so the reply is deterministic.
+        items = list(dict.fromkeys(unquote(b) for b in items))
 
         games = []
         not_found = []
 
+        # names given as IDs ('#1234', e.g. from expandurls) are fetched in batches.
+        ids = {name: self._gameIdFromName(name) for name in items}
+        batch_ids = list(dict.fromkeys(i for i in ids.values() if i is not None))
+        batches = list()
+        for start in range(0, len(batch_ids), self.BGG_BATCH_SIZE):
+            chunk = batch_ids[start:start + self.BGG_BATCH_SIZE]
+            batches.append((chunk, pool.submit(self._bggFetchGames, chunk)))
+
+        # resolve all names at once. The reply then only waits as long as the slowest lookup.
+        lookups = dict()
+        for game_name in items:
+            if ids[game_name] is None:
+                log.info('asking BGG for info on {}'.format(game_name))
+                lookups[game_name] = pool.submit(self._bggQueryGame, game_name)
+
+        fetched = dict()
+        failed = set()
+        errors = list()
+        for chunk, batch in batches:
+            try:
+                fetched.update(batch.result())
+            except self.bggError() as e:
+                log.error('Error getting info from BGG on {}: {}'.format(chunk, e))
+                failed.update(chunk)
+                errors.append(e)
+
         seen = set()
         for game_name in items:
-            log.info('asking BGG for info on {}'.format(game_name))
+            if ids[game_name] in failed:
+                continue
+
             try:
-                # game = self._bgg.game(game_name)
-                game = self._bggQueryGame(game_name)
+                if ids[game_name] is not None:
+                    game = fetched.get(ids[game_name])
+                else:
+                    game = lookups[game_name].result()
                 if game:
                     if game.id not in seen:
                         games.append(game)
@@ -175,10 +491,16 @@ class CommentHandler(object):
                 else:
                     not_found.append(game_name)
 
-            except boardgamegeek.exceptions.BoardGameGeekError as e:
+            except self.bggError() as e:
                 log.error('Error getting info from BGG on {}: {}'.format(game_name, e))
+                errors.append(e)
                 continue
 
+        # nothing worked, BGG is likely down. Fail so the request is tried again later rather
+        # than answered with nothing.
+        if errors and not games:
+            raise errors[-1]
+
         # sort by game name because why not?
         if sort and sort in self.SORT_FUNCTIONS:
             fn = self.SORT_FUNCTIONS.get(sort)
@@ -188,9 +510,7 @@ class CommentHandler(object):
 
     def _getBoldedEntries(self, comment):
         body = comment.body
-        # bolded = re.findall(u'\*\*([^\*]+)\*\*', body)
-        # Now I've got two problems.
-        bolded = re.findall('\*\*(#?[\w][\w\.\s:\-?$,!\'–&()\[\]]*[\w\.:\-?$,!\'–&()\[\]])\*\*', body, flags=re.UNICODE)
+        bolded = list(CommentParser.tokenize(body).bolded)
         if not bolded:
             log.warn('Got getinfo command, but nothing is bolded. Ignoring comment.')
             log.debug('comment was: {}'.format(body))
@@ -202,11 +522,14 @@ class CommentHandler(object):
                 bolded = [choice(cjgames), 'Keyforge', 'Keyforge', 'Keyforge']
         return bolded
 
-    def _getInfoResponseBody(self, comment, gameNames, mode, columns=None, sort=None):
+    def _getInfoReply(self, comment, gameNames, mode, columns=None, sort=None, pool=None):
+        '''Build the reply for gameNames, looking them up on pool. Returns the reply body and a
+        record of the per-game blocks it was made from, which lets a later repair change just
+        the blocks it needs to.'''
         assert mode
         assert gameNames
 
-        [games, not_found] = self._findGames(gameNames, sort)
+        [games, not_found] = self._findGames(gameNames, sort, pool)
 
         # disallow long mode for 
         if mode == 'long' and len(games) > 6:
@@ -226,27 +549,70 @@ class CommentHandler(object):
 
         log.warning('Using mode {} and columns {}'.format(mode, columns))
 
+        with metrics.timer('r2d8_render_seconds', mode=mode):
+            blocks = self._getInfoBlocks(games, mode, columns)
+
+        record = {
+            'mode': mode,
+            'columns': columns,
+            'blocks': blocks,
+            'not_found': not_found if not_found else []
+        }
+        return self._assembleReply(record), record
+
+    def _getInfoBlocks(self, games, mode, columns=None):
+        '''Render games in the given mode. Returns a list of [game id, game name, markdown], with
+        a None id for parts that don't belong to a game, like table headers.'''
+        if mode == 'tabular':
+            assert columns
+            rows = self._getInfoTable(games, columns)
+            return ([[None, None, r] for r in rows[:2]] +
+                    [[g.id, g.name, r] for g, r in zip(games, rows[2:])])
+
         if mode == 'short':
             infos = self._getShortInfos(games)
         elif mode == 'long':
             infos = self._getLongInfos(games)
-        elif mode == 'tabular':
-            assert columns
-            infos = self._getInfoTable(games, columns)
         else:
             infos = self._getStdInfos(games)
 
+        return [[g.id, g.name, i] for g, i in zip(games, infos)]
+
+    def _assembleReply(self, record):
+        '''Put a reply body together from the record made by _getInfoReply.'''
+        infos = [block for _, _, block in record['blocks']]
+
         # append not found string if we didn't find a bolded string.
-        if not_found:
+        if record['not_found']:
             not_found = ['[{}](http://boardgamegeek.com/geeksearch.php?action=search'
                          '&objecttype=boardgame&q={}&B1=Go)'.format(
-                             n, quote(n)) for n in not_found]
+                             n, quote(n)) for n in record['not_found']]
             infos.append('\n\nBolded items not found at BGG (click to search): {}\n\n'.format(', '.join(not_found)))
 
+        if record.get('more'):
+            infos.append('\n\n...and {} more, too many to show in one comment.\n\n'.format(record['more']))
+
         response = None
         if len(infos):
-            response = self._header + '\n'.join([i for i in infos]) + self._footer
-            # TODO: why the copied list?
+            response = self._header + '\n'.join(infos) + self._footer
+
+        return response
+
+    def _fitReply(self, record):
+        '''Put the reply for record together, leaving games off the end until it fits in a
+        reddit comment along with the record's footer.'''
+        footer = record.get('footer', '')
+        response = self._assembleReply(record)
+        while response and len(response) + len(footer) > self.MAX_REPLY_LENGTH:
+            if record['not_found']:
+                record['not_found'].pop()
+            else:
+                games = [i for i, block in enumerate(record['blocks']) if block[0] is not None]
+                if not games:
+                    break
+                del record['blocks'][games[-1]]
+                record['more'] = record.get('more', 0) + 1
+            response = self._assembleReply(record)
 
         return response
 
@@ -268,8 +634,21 @@ class CommentHandler(object):
         'tabular'
     ]
     DEFAULT_DISPLAY_MODE = 'standard'
+    # reddit won't take a comment longer than this.
+    MAX_REPLY_LENGTH = 10000
+
+    def _getSort(self, subcommands):
+        '''The sort function name asked for in subcommands.'''
+        if self.NO_SORT_KEYWORD in subcommands:
+            return None
+
+        for sort_type in self.SORT_FUNCTIONS.keys():
+            if sort_type in subcommands:
+                return sort_type
+
+        return self.DEFAULT_SORT
 
-    def getInfo(self, comment: praw.models.Comment, subcommands: list, config: dict, replyTo = None):
+    def getInfo(self, comment: 'praw.models.Comment', subcommands: list, config: dict, replyTo = None):
         '''Reply to comment with game information. If replyTo is given reply to original else
         reply to given comment.'''
         if self._botdb.ignore_user(comment.author.name):
@@ -283,26 +662,21 @@ class CommentHandler(object):
             mode = self.DEFAULT_DISPLAY_MODE
         columns = subcommands[1:] if mode == 'tabular' else None
 
-        sort = self.DEFAULT_SORT
-        if self.NO_SORT_KEYWORD in subcommands:
-            sort = None
-        else:
-            for sort_type in self.SORT_FUNCTIONS.keys():
-                if sort_type in subcommands:
-                    sort = sort_type
-                    break
+        sort = self._getSort(subcommands)
 
         footer = '\n' + config['footer'] if 'footer' in config else ''
 
         bolded = self._getBoldedEntries(comment)
         response = None
         if bolded:
-            response = self._getInfoResponseBody(comment, bolded, mode, columns, sort)
+            response, record = self._getInfoReply(comment, bolded, mode, columns, sort)
         if response:
+            record['footer'] = footer
+            response = self._fitReply(record)
             if replyTo:
-                replyTo.reply(response + footer)
+                self.replier(replyTo, response + footer, record=record)
             else:
-                comment.reply(response + footer)
+                self.replier(comment, response + footer, record=record)
             log.info('Replied to info request for comment {}'.format(comment.id))
         else:
             log.warn('Did not find anything to reply to in comment {}'.format(comment.id))
@@ -310,49 +684,57 @@ class CommentHandler(object):
     def _getShortInfos(self, games):
         infos = list()
         for game in games:
-            players = self._getPlayers(game)
-            info = (' * [**{}**](http://boardgamegeek.com/boardgame/{}) '
-                    ' ({}) by {}. '.format(
-                        game.name, game.id, game.year, ', '.join(getattr(game, 'designers', 'Unknown'))))
-            if players:
-                info += '{}; '.format(players)
-            if game.playing_time and int(game.playing_time) != 0:
-                info += '{} mins '.format(game.playing_time)
-
+            info = self._renderCache.render(game, 'short', None, self._renderShort)
             infos.append(info)
 
         return infos
 
+    def _renderShort(self, game):
+        players = self._getPlayers(game)
+        info = [' * [**{}**](http://boardgamegeek.com/boardgame/{}) '
+                ' ({}) by {}. '.format(
+                    game.name, game.id, game.year, ', '.join(getattr(game, 'designers', 'Unknown')))]
+        if players:
+            info.append('{}; '.format(players))
+        if game.playing_time and int(game.playing_time) != 0:
+            info.append('{} mins '.format(game.playing_time))
+
+        return ''.join(info)
+
     def _getStdInfos(self, games):
         infos = list()
         for game in games:
-            players = self._getPlayers(game)
-            info = ('[**{}**](http://boardgamegeek.com/boardgame/{}) '
-                    ' ({}) by {}. {}; '.format(
-                        game.name, game.id, game.year, ', '.join(getattr(game, 'designers', 'Unknown')),
-                        players))
+            info = self._renderCache.render(game, 'standard', None, self._renderStd)
+            log.debug('adding info: {}'.format(info))
+            infos.append(info)
 
-            if game.playing_time and int(game.playing_time) != 0:
-                info += '{} minutes; '.format(game.playing_time)
+        return infos
 
-            if game.image:
-                info += '[BGG Image]({}) '.format(game.image)
+    def _renderStd(self, game):
+        players = self._getPlayers(game)
+        info = ['[**{}**](http://boardgamegeek.com/boardgame/{}) '
+                ' ({}) by {}. {}; '.format(
+                    game.name, game.id, game.year, ', '.join(getattr(game, 'designers', 'Unknown')),
+                    players)]
 
-            info += '\n\n'
+        if game.playing_time and int(game.playing_time) != 0:
+            info.append('{} minutes; '.format(game.playing_time))
 
-            data = ', '.join(getattr(game, 'mechanics', ''))
-            if data:
-                info += ' * Mechanics: {}\n'.format(data)
-            people = 'people' if game.users_rated > 1 else 'person'
-            info += ' * Average rating is {}; rated by {} {}. Weight: {}\n'.format(
-                game.rating_average, game.users_rated, people, game.rating_average_weight)
-            data = ', '.join(['{}: {}'.format(r['friendlyname'], r['value']) for r in game.ranks])
-            info += ' * {}\n\n'.format(data)
+        if game.image:
+            info.append('[BGG Image]({}) '.format(game.image))
 
-            log.debug('adding info: {}'.format(info))
-            infos.append(info)
+        info.append('\n\n')
 
-        return infos
+        data = ', '.join(getattr(game, 'mechanics', ''))
+        if data:
+            info.append(' * Mechanics: {}\n'.format(data))
+        people = 'people' if game.users_rated > 1 else 'person'
+        info.append(' * Average rating is {}; rated by {} {}. Weight: {}\n'.format(
+            game.rating_average, game.users_rated, people, game.rating_average_weight))
+        data = ', '.join(['{}: {}'.format(r['friendlyname'], r['value']) for r in game.ranks])
+        info.append(' * {}\n\n'.format(data))
+
+        return ''.join(info)
 
     ALLOWED_COLUMNS = {
         'year': 'Year Published',
@@ -369,7 +751,7 @@ class CommentHandler(object):
         'id': 'BGG ID'
     }
 
-    def _getGameColumn(self, game: boardgamegeek.games.BoardGame, column):
+    def _getGameColumn(self, game: GameRecord, column):
         if column == 'year':
             return str(game.year)
         elif column == 'rank':
@@ -393,8 +775,8 @@ class CommentHandler(object):
     def _getInfoTable(self, games, columns):
         rows = list()
         # build header
-        header = 'Game Name'
-        alignment = ':--'
+        header = ['Game Name']
+        alignment = [':--']
         unknownColumns = list()
 
         for column in columns:
@@ -402,51 +784,31 @@ class CommentHandler(object):
                 log.info('Unknown tabular column {}, skipping'.format(column))
                 unknownColumns.append(column)
                 continue
-            header = header + '|' + self.ALLOWED_COLUMNS[column]
-            alignment = alignment + '|:--'
+            header.append(self.ALLOWED_COLUMNS[column])
+            alignment.append(':--')
 
-        rows.append(header)
-        rows.append(alignment)
+        rows.append('|'.join(header))
+        rows.append('|'.join(alignment))
         columns = [c for c in columns if c not in unknownColumns]
 
         # build rows
         for game in games:
-            row = '[**{}**](http://boardgamegeek.com/boardgame/{})'.format(game.name, game.id)
-            for column in columns:
-                row = row + '|' + self._getGameColumn(game, column)
+            row = self._renderCache.render(game, 'tabular', columns,
+                                           lambda g: self._renderRow(g, columns))
             log.info('adding info: {}'.format(row))
             rows.append(row)
 
         return rows
 
+    def _renderRow(self, game, columns):
+        row = ['[**{}**](http://boardgamegeek.com/boardgame/{})'.format(game.name, game.id)]
+        row.extend(self._getGameColumn(game, column) for column in columns)
+        return '|'.join(row)
+
     def _getLongInfos(self, games):
         infos = list()
         for game in games:
-            players = self._getPlayers(game)
-            info = ('Details for [**{}**](http://boardgamegeek.com/boardgame/{}) '
-                    ' ({}) by {}. '.format(
-                        game.name, game.id, game.year, ', '.join(getattr(game, 'designers', 'Unknown'))))
-            if players:
-                info += '{}; '.format(players)
-            if game.playing_time and int(game.playing_time) != 0:
-                info += '{} minutes; '.format(game.playing_time)
-            if game.image:
-                info += '[BGG Image]({}) '.format(game.image)
-            info += '\n\n'
-
-            data = ', '.join(getattr(game, 'mechanics', ''))
-            if data:
-                info += ' * Mechanics: {}\n'.format(data)
-            people = 'people' if game.users_rated > 1 else 'person'
-            info += ' * Average rating is {}; rated by {} {}\n'.format(
-                game.rating_average, game.users_rated, people)
-            info += ' * Average Weight: {}; Number of Weights {}\n'.format(
-                game.rating_average_weight, game.rating_num_weights)
-            data = ', '.join(['{}: {}'.format(r['friendlyname'], r['value']) for r in game.ranks])
-            info += ' * {}\n\n'.format(data)
-
-            info += 'Description:\n\n{}\n\n'.format(game.description)
-
+            info = self._renderCache.render(game, 'long', None, self._renderLong)
             if len(games) > 1:
                 info += '------'
 
@@ -455,7 +817,35 @@ class CommentHandler(object):
 
         return infos
 
-    def repairComment(self, comment: praw.models.Comment, subcommands: list, config: dict):
+    def _renderLong(self, game):
+        players = self._getPlayers(game)
+        info = ['Details for [**{}**](http://boardgamegeek.com/boardgame/{}) '
+                ' ({}) by {}. '.format(
+                    game.name, game.id, game.year, ', '.join(getattr(game, 'designers', 'Unknown')))]
+        if players:
+            info.append('{}; '.format(players))
+        if game.playing_time and int(game.playing_time) != 0:
+            info.append('{} minutes; '.format(game.playing_time))
+        if game.image:
+            info.append('[BGG Image]({}) '.format(game.image))
+        info.append('\n\n')
+
+        data = ', '.join(getattr(game, 'mechanics', ''))
+        if data:
+            info.append(' * Mechanics: {}\n'.format(data))
+        people = 'people' if game.users_rated > 1 else 'person'
+        info.append(' * Average rating is {}; rated by {} {}\n'.format(
+            game.rating_average, game.users_rated, people))
+        info.append(' * Average Weight: {}; Number of Weights {}\n'.format(
+            game.rating_average_weight, game.rating_num_weights))
+        data = ', '.join(['{}: {}'.format(r['friendlyname'], r['value']) for r in game.ranks])
+        info.append(' * {}\n\n'.format(data))
+
+        info.append('Description:\n\n{}\n\n'.format(game.description))
+
+        return ''.join(info)
+
+    def repairComment(self, comment: 'praw.models.Comment', subcommands: list, config: dict):
         '''Look for maps from missed game names to actual game names. If
         found repair orginal comment.'''
         if self._botdb.ignore_user(comment.author.name):
@@ -481,25 +871,20 @@ class CommentHandler(object):
 
         # Look for patterns of **something**=**somethingelse**. This line creates a dict
         # of something: somethingelse for each one pattern found.
-        repairs = {match[0]: match[1] for match in re.findall(
-            '\*\*([^\*]+)\*\*=\*\*([^\*]+)\*\*', comment.body)}
+        repairs = {match[0]: match[1] for match in CommentParser.tokenize(comment.body).repairs}
+
+        # if we know how the reply was built, only the repaired games need looking up.
+        record = self._botdb.get_reply(parent.id)
+        if record:
+            self._repairBlocks(record, repairs)
+            new_reply = self._fitReply(record)
+            if new_reply:
+                log.debug('Replacing bot comment {} with: {}'.format(parent.id, new_reply))
+                self.editor(parent, new_reply + record.get('footer', ''), record=record)
+            return
 
-        pbody = parent.body
         for wrongName, repairedName in repairs.items():
-            # check to see if it's actually a game.
             log.info('Repairing {} --> {}'.format(wrongName, repairedName))
-            alias = self._botdb.get_name_from_alias(repairedName)
-            tmp_name = alias if alias else repairedName
-            tmp_game = self._bggQueryGame(tmp_name)  # with caching it's ok to check twice
-            if tmp_game:
-                # In the parent body we want to replace [NAME](http://... with **NAME**(http://
-                pbody = pbody.replace('[' + wrongName + ']', '**' + tmp_name + '**')
-            else:
-                log.info('{} seems to not be a game name according to BGG, ignoring.'.format(tmp_name))
-
-        # Now re-bold the not found strings so they are re-searched or re-added to the not found list.
-        for nf in re.findall('\[([\w|\s]+)]\(http://boardgamegeek.com/geeksearch.php', pbody):
-            pbody += ' **{}**'.format(nf)
 
         # now re-insert the original command to retain the mode.
         grandparent = parent.parent()
@@ -507,22 +892,59 @@ class CommentHandler(object):
         if not grandparent:
             log.error('Cannot find original GP post. Assuming normal mode.')
         else:
-            modes = re.findall('[getparent|get]info\s(\w+)', grandparent.body)
+            modes = CommentParser.INFO_MODE_REGEX.findall(grandparent.body)
 
         targetmode = modes[0] if modes else self.DEFAULT_DISPLAY_MODE
 
-        parent = parent.edit(pbody)
+        # the reply is rebuilt from the repair comment's bolded names, so it's edited just once,
+        # with the record saved so the next repair can use the quick way above.
         bolded = self._getBoldedEntries(comment)
-        new_reply = self._getInfoResponseBody(parent, bolded, targetmode)
+        new_reply, record = self._getInfoReply(parent, bolded, targetmode)
+        new_reply = self._fitReply(record)
 
         # should check for Editiable class somehow here. GTL
         log.debug('Replacing bot comment {} with: {}'.format(parent.id, new_reply))
-        parent.edit(new_reply)
+        self.editor(parent, new_reply, record=record)
+
+    def _repairBlocks(self, record, repairs):
+        '''Swap the blocks for wrong names in a reply record for blocks for the repaired names.'''
+        mode = record['mode']
+        for wrongName, repairedName in repairs.items():
+            log.info('Repairing {} --> {}'.format(wrongName, repairedName))
+            alias = self._botdb.get_name_from_alias(repairedName)
+            tmp_name = alias if alias else repairedName
+            game = self._bggQueryGame(tmp_name)
+            if not game:
+                log.info('{} seems to not be a game name according to BGG, ignoring.'.format(tmp_name))
+                continue
+
+            wrong = wrongName.lower()
+            blocks = record['blocks']
+            index = [i for i, (gid, name, _) in enumerate(blocks) if name and name.lower() == wrong]
+            not_found = [n for n in record['not_found'] if n.lower() != wrong]
+            if not index and len(not_found) == len(record['not_found']):
+                log.info('{} is not in the reply, ignoring.'.format(wrongName))
+                continue
+            record['not_found'] = not_found
 
-    def xyzzy(self, comment: praw.models.Comment, subcommands: list, config: dict):
-        comment.reply('Nothing happens.')
+            if any(gid == game.id for gid, _, _ in blocks):
+                # already in the reply, just drop the wrong one.
+                for i in reversed(index):
+                    del blocks[i]
+                continue
+
+            new_block = self._getInfoBlocks([game], mode, record['columns'])[-1]
+            if mode == 'long' and blocks:
+                new_block[2] += '------'
+            if index:
+                blocks[index[0]] = new_block
+            else:
+                blocks.append(new_block)
 
-    def getParentInfo(self, comment: praw.models.Comment, subcommands: list, config: dict):
+    def xyzzy(self, comment: 'praw.models.Comment', subcommands: list, config: dict):
+        self.replier(comment, 'Nothing happens.')
+
+    def getParentInfo(self, comment: 'praw.models.Comment', subcommands: list, config: dict):
         '''Allows others to call the bot to getInfo for parent posts.'''
         if self._botdb.ignore_user(comment.author.name):
             log.info("Ignoring comment by {}".format(comment.author.name))
@@ -538,7 +960,7 @@ class CommentHandler(object):
         parent = comment.parent()
         self.getInfo(parent, subcommands=subcommands, config=config, replyTo=comment)
 
-    def alias(self, comment: praw.models.Comment, subcommands: list, config: dict):
+    def alias(self, comment: 'praw.models.Comment', subcommands: list, config: dict):
         '''add an alias to the database.'''
         if not self._botdb.is_admin(comment.author.name):
             log.info('got alias command from non admin {}, ignoring.'.format(
@@ -546,16 +968,15 @@ class CommentHandler(object):
             return
 
         response = 'executing alias command.\n\n'
-        # TODO: use bold fn
-        for match in re.findall('\*\*([^\*]+)\*\*=\*\*([^\*]+)\*\*', comment.body):
+        for match in CommentParser.tokenize(comment.body).repairs:
             mess = 'Adding alias to database: "{}" = "{}"'.format(match[0], match[1])
             log.info(mess)
             response += mess + '\n\n'
             self._botdb.add_alias(match[0], match[1])
 
-        comment.reply(response)
+        self.replier(comment, response)
 
-    def getaliases(self, comment: praw.models.Comment, subcommands: list, config: dict):
+    def getaliases(self, comment: 'praw.models.Comment', subcommands: list, config: dict):
         if self._botdb.ignore_user(comment.author.name):
             log.info("Ignoring comment by {}".format(comment.author.name))
             return
@@ -566,9 +987,9 @@ class CommentHandler(object):
             response += ' * {} = {}\n'.format(alias, name)
 
         log.info('Responding to getalaises request with {} aliases'.format(len(aliases)))
-        comment.reply(response)
+        self.replier(comment, response)
 
-    def expandURLs(self, comment: praw.models.Comment, subcommands: list, config: dict):
+    def expandURLs(self, comment: 'praw.models.Comment', subcommands: list, config: dict):
         if self._botdb.ignore_user(comment.author.name):
             log.info("Ignoring comment by {}".format(comment.author.name))
             return
@@ -583,20 +1004,22 @@ class CommentHandler(object):
         footer = '\n' + config['footer'] if 'footer' in config else ''
 
         body = comment.body
-        urls = [('#' + id) for id in re.findall('boardgamegeek.com/(?:boardgame|thing)/(\d+)', body, flags=re.UNICODE)]
+        urls = [('#' + id) for id in CommentParser.tokenize(body).urls]
 
-        response = self._getInfoResponseBody(comment, urls, mode)
+        response, record = self._getInfoReply(comment, urls, mode)
         log.error('footer {} ({})'.format(footer, type(footer)))
         if response:
+            record['footer'] = footer
+            response = self._fitReply(record)
             if replyTo:
-                replyTo.reply(response + footer)
+                self.replier(replyTo, response + footer, record=record)
             else:
-                comment.reply(response + footer)
+                self.replier(comment, response + footer, record=record)
             log.info('Replied to info request for comment {}'.format(comment.id))
         else:
             log.warn('Did not find anything to reply to in comment {}'.format(comment.id))
 
-    def removalRequest(self, comment: praw.models.Comment, subcommands: list, config: dict):
+    def removalRequest(self, comment: 'praw.models.Comment', subcommands: list, config: dict):
         # if self._botdb.ignore_user(comment.author.name):
         #     log.info("Ignoring comment by {}".format(comment.author.name))
         #     return
@@ -611,28 +1034,87 @@ class CommentHandler(object):
             log.error('removal requested on top-level comment {}, ignoring'.format(comment.id))
             return
         
-        botmessage: praw.models.Comment = comment.parent()
+        botmessage: 'praw.models.Comment' = comment.parent()
         try:
             # delete the post
             botmessage.delete()
             # attempt to unmark the parent as read
             if not botmessage.is_root:
                 self._botdb.remove_comment(botmessage.parent)
-        except boardgamegeek.exceptions.BoardGameGeekError as e:
+        except self.bggError() as e:
             log.error('Error deleting comment {} by {}'.format(original.id, original.author.name))
         return
 
-    # def getThreadInfo(self, comment: praw.models.Comment, subcommands: list, config: dict):
-    #     '''get info for all top-level comments in a single thread'''
-    #     if self._botdb.ignore_user(comment.author.name):
-    #         log.info("Ignoring comment by {}".format(comment.author.name))
-    #         return
-    #     if (not comment.is_root):
-    #         # TODO: respond directly to the user
-    #         comment.author.message('r2d8 command error', 
-    #             'The `getthreadinfo` command must be used in a top-level comment.\n\nFor questions and issues, please visit /r/r2d8.')
-    #         return
+    # limits on how much of a thread getthreadinfo reads, so huge threads stay cheap.
+    THREAD_MORE_LIMIT = 50      # "load more comments" links followed.
+    # distinct bolded names looked up, about as many table rows as fit in one reply.
+    THREAD_NAME_LIMIT = MAX_REPLY_LENGTH // 80
+    THREAD_LOOKUP_THREADS = 2   # concurrent BGG lookups for getthreadinfo.
+    THREAD_COLUMNS = ['year', 'rank', 'rating']
+
+    def _threadBodies(self, submission):
+        '''Yield the body of every top-level comment in the submission, loading more of them as
+        needed. Replies are never loaded.'''
+        from praw.models import MoreComments
+        more = list()
+
+        def follow(stub):
+            # "more" stubs under replies would only load replies. The ones we keep need to know
+            # their submission, which praw's replace_more sets but comments() doesn't.
+            if stub.parent_id == submission.fullname:
+                stub.submission = submission
+                more.append(stub)
+
+        for top in submission.comments:
+            if isinstance(top, MoreComments):
+                follow(top)
+            elif top.author and top.author.name != self._botname:
+                yield top.body
+
+        followed = 0
+        while more and followed < self.THREAD_MORE_LIMIT:
+            followed += 1
+            for top in more.pop(0).comments(update=False):
+                if isinstance(top, MoreComments):
+                    follow(top)
+                elif top.is_root and top.author and top.author.name != self._botname:
+                    yield top.body
+
+        if more:
+            log.info('Stopped reading thread {} with {} "more comments" left'.format(
+                submission.id, len(more)))
+
+    def getThreadInfo(self, comment: 'praw.models.Comment', subcommands: list, config: dict):
+        '''get info for all top-level comments in a single thread'''
+        if self._botdb.ignore_user(comment.author.name):
+            log.info("Ignoring comment by {}".format(comment.author.name))
+            return
+        if (not comment.is_root):
+            self.messenger(comment.author, 'The `getthreadinfo` command must be used in a top-level '
+                           'comment.\n\nFor questions and issues, please visit /r/r2d8.',
+                           subject='r2d8 command error')
+            return
 
+        # only the names are kept, de-duplicated across the whole thread.
+        names = dict()
+        for body in self._threadBodies(comment.submission):
+            for name in CommentParser.tokenize(body).bolded:
+                names[name] = None
+            if len(names) >= self.THREAD_NAME_LIMIT:
+                log.info('Got {} names in thread, not reading any more.'.format(len(names)))
+                break
+
+        if not names:
+            log.warn('Found no bolded names in thread for comment {}'.format(comment.id))
+            return
 
-    #     for c in comment.parent().comments:
-    #         continue # TODO here
+        columns = [c for c in subcommands if c in self.ALLOWED_COLUMNS] or self.THREAD_COLUMNS
+        footer = '\n' + config['footer'] if 'footer' in config else ''
+        response, record = self._getInfoReply(comment, list(names)[:self.THREAD_NAME_LIMIT], 'tabular',
+                                              columns, self._getSort(subcommands),
+                                              self._threadLookupPool)
+        if response:
+            record['footer'] = footer
+            response = self._fitReply(record)
+            self.replier(comment, response + footer, record=record)
+            log.info('Replied to thread info request for comment {}'.format(comment.id))
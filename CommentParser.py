@@ -0,0 +1,65 @@
+import logging
+import re
+from collections import namedtuple
+from functools import lru_cache
+from Metrics import metrics
+
+log = logging.getLogger(__name__)
+
+# Every pattern the bot uses, compiled once.
+
+# **Game Name** - the characters allowed in a bolded game name.
+BOLDED_NAME = '#?[\\w][\\w\\.\\s:\\-?$,!\'–&()\\[\\]]*[\\w\\.:\\-?$,!\'–&()\\[\\]]'
+BOLDED_REGEX = re.compile('\\*\\*({})\\*\\*'.format(BOLDED_NAME), re.UNICODE)
+BOLDED_NAME_REGEX = re.compile(BOLDED_NAME, re.UNICODE)
+# **wrong name**=**right name**, used by repair and alias.
+REPAIR_REGEX = re.compile('\\*\\*([^\\*]+)\\*\\*=\\*\\*([^\\*]+)\\*\\*')
+BGG_URL_REGEX = re.compile('boardgamegeek.com/(?:boardgame|thing)/(\\d+)', re.UNICODE)
+INFO_MODE_REGEX = re.compile('[getparent|get]info\\s(\\w+)')
+
+# game name clean up, in the order they are tried.
+GAME_ID_REGEX = re.compile('^#(\\d+)$')
+EMBEDDED_URL_REGEX = re.compile('\\[([^]]*)\\]')
+LEADING_THE_REGEX = re.compile('^the ')
+INNER_THE_REGEX = re.compile('\\sthe\\s')
+NAME_SUBSTITUTIONS = [
+    (re.compile('[?!.:,]*'), '', 'removing punctuation', 'punctuation'),
+    (re.compile('\\sand\\s'), ' & ', 'and --> &', 'and_to_amp'),
+    (re.compile('\\s&\\s'), ' and ', '& --> and', 'amp_to_and')
+]
+
+# everything the bot looks for in a comment body, so it can be found in one scan. Repairs come
+# first as they are made of two bolded names.
+TOKEN_REGEX = re.compile(
+    '(?P<repair>{repair})|(?P<bolded>{bolded})|{url}'.format(
+        repair=REPAIR_REGEX.pattern, bolded=BOLDED_REGEX.pattern, url=BGG_URL_REGEX.pattern)
+    .replace('(\\d+)', '(?P<url>\\d+)'),
+    re.UNICODE)
+
+ParsedComment = namedtuple('ParsedComment', ['bolded', 'urls', 'repairs'])
+
+
+@lru_cache(maxsize=256)
+def tokenize(body):
+    '''Pull bolded names, BGG game IDs from URLs and **a**=**b** pairs out of a comment body in
+    a single pass. Bolded names include both halves of a pair, as they are bolded too.'''
+    with metrics.timer('r2d8_parse_seconds'):
+        return _tokenize(body)
+
+
+def _tokenize(body):
+    bolded = list()
+    urls = list()
+    repairs = list()
+    for m in TOKEN_REGEX.finditer(body):
+        if m.group('repair'):
+            pair = REPAIR_REGEX.fullmatch(m.group('repair')).groups()
+            repairs.append(pair)
+            bolded.extend(name for name in pair if BOLDED_NAME_REGEX.fullmatch(name))
+            urls.extend(BGG_URL_REGEX.findall(m.group('repair')))
+        elif m.group('bolded'):
+            bolded.append(BOLDED_REGEX.fullmatch(m.group('bolded')).group(1))
+        else:
+            urls.append(m.group('url'))
+
+    return ParsedComment(tuple(bolded), tuple(urls), tuple(repairs))
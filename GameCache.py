@@ -0,0 +1,163 @@
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from random import random
+from time import time
+from GameRecord import GameRecord
+
+log = logging.getLogger(__name__)
+
+
+class GameCache(object):
+    '''In memory LRU cache of parsed BGG games, looked up by game id or by any name the game
+    was found under. Entries expire after about ttl seconds, jittered so games fetched together
+    don't all expire together. Expired games are still returned for stale_grace seconds while
+    they are refreshed in the background, see Prefetcher.'''
+    DEFAULT_SIZE = 1000
+    # expiry times are spread over the last JITTER fraction of the ttl.
+    JITTER = 0.1
+    # decayed request counts below this are forgotten; a single request lasts about 4 half lives.
+    MIN_REQUESTS = 0.05
+
+    def __init__(self, max_games=DEFAULT_SIZE, ttl=86400, stale_grace=0):
+        super(GameCache, self).__init__()
+        self._max_games = max(1, max_games)
+        self._ttl = ttl
+        self._stale_grace = stale_grace
+        self._requests = dict()        # id: how often it was asked for lately.
+        self._decayed = time()         # when the request counts were last decayed.
+        self._games = OrderedDict()    # id: (expires, game), least recently used first.
+        self._names = dict()           # name: id
+        self._game_names = dict()      # id: set of names
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale_hits = 0
+
+    @staticmethod
+    def _normalize(name):
+        return name.lower().strip()
+
+    def get(self, game_id, request=True, stats=True):
+        '''Return the game with the given id, or None if it is not cached. request says someone
+        asked for the game, which counts towards how popular it is, and stats that the lookup
+        counts as a hit or a miss.'''
+        with self._lock:
+            now = time()
+            entry = self._games.get(game_id)
+            if entry and entry[0] + self._stale_grace < now:
+                self._remove(game_id)
+                entry = None
+
+            if request:
+                self._requests[game_id] = self._requests.get(game_id, 0) + 1
+            if not entry:
+                if stats:
+                    self.misses += 1
+                return None
+
+            self._games.move_to_end(game_id)
+            if stats:
+                self.hits += 1
+                if entry[0] < now:
+                    self.stale_hits += 1
+            return entry[1]
+
+    def get_by_name(self, name):
+        '''Return the game last found under name, or None if it is not cached.'''
+        with self._lock:
+            game_id = self._names.get(self._normalize(name))
+        if game_id is None:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        return self.get(game_id)
+
+    def put(self, game, names=()):
+        '''Cache game, also making it available under each of names.'''
+        with self._lock:
+            self._games[game.id] = (time() + self._ttl * (1 - self.JITTER * random()), game)
+            self._games.move_to_end(game.id)
+            for name in names:
+                name = self._normalize(name)
+                self._names[name] = game.id
+                self._game_names.setdefault(game.id, set()).add(name)
+
+            while len(self._games) > self._max_games:
+                self._remove(next(iter(self._games)))
+                self.evictions += 1
+
+    def _remove(self, game_id):
+        self._games.pop(game_id, None)
+        for name in self._game_names.pop(game_id, ()):
+            if self._names.get(name) == game_id:
+                del self._names[name]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._games),
+                'max_size': self._max_games,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'stale_hits': self.stale_hits
+            }
+
+    def refresh_candidates(self, count, ahead):
+        '''Return the ids of the count most asked for games that have expired or will expire
+        within ahead seconds, hottest first.'''
+        with self._lock:
+            soon = time() + ahead
+            hottest = sorted(self._requests.items(), key=lambda r: -r[1])[:count]
+            return [game_id for game_id, _ in hottest
+                    if game_id in self._games and self._games[game_id][0] < soon]
+
+    def decay_requests(self, half_life):
+        '''Decay the request counts so they halve every half_life seconds, and track recent
+        popularity. Can be called as often as wanted, the decay goes by the time since the last
+        call.'''
+        with self._lock:
+            now = time()
+            scale = 0.5 ** ((now - self._decayed) / half_life)
+            self._decayed = now
+            self._requests = {game_id: n * scale for game_id, n in self._requests.items()
+                              if n * scale >= self.MIN_REQUESTS}
+
+    def save(self, path):
+        '''Write the cached games to path, one JSON object per line, so a restarted bot can
+        start with a warm cache.'''
+        with self._lock:
+            entries = [(expires, game, sorted(self._game_names.get(game_id, ())))
+                       for game_id, (expires, game) in self._games.items()]
+
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as fd:
+            for expires, game, names in entries:
+                fd.write(json.dumps({'expires': expires, 'names': names, 'game': game.to_dict()}))
+                fd.write('\n')
+        os.replace(tmp, path)
+        log.info('Saved {} games to {}'.format(len(entries), path))
+
+    def load(self, path):
+        '''Read games written by save(), skipping any that have expired since.'''
+        if not os.path.exists(path):
+            return
+
+        now = time()
+        count = 0
+        with open(path, encoding='utf-8') as fd:
+            for line in fd:
+                entry = json.loads(line)
+                game = GameRecord.from_dict(entry['game'])
+                if not game or entry['expires'] < now:
+                    continue
+                self.put(game, entry['names'])
+                with self._lock:
+                    self._games[game.id] = (entry['expires'], game)
+                count += 1
+        log.info('Loaded {} games from {}'.format(count, path))
@@ -0,0 +1,146 @@
+import csv
+import logging
+import re
+from collections import namedtuple
+from difflib import SequenceMatcher
+from xml.etree import ElementTree
+
+log = logging.getLogger(__name__)
+
+CatalogueGame = namedtuple('CatalogueGame', ['id', 'name', 'owned', 'rank', 'expansion'])
+
+
+class GameCatalogue(object):
+    '''Local snapshot of the BGG catalogue, used to turn game names into BGG ids without asking
+    BGG. Names are matched after normalizing away case, punctuation, "the"s and "&" vs "and",
+    then by trigram similarity to catch typos.
+
+    Load it from the BGG rank dump CSV (id, name, rank, is_expansion, ... columns, optionally
+    with owned and alternate_names columns, alternate names separated by "|"), or from BGG XML
+    API thing responses.'''
+    # how alike a typo has to be to the real name to count, from 0 to 1.
+    MIN_SIMILARITY = 0.85
+    # fuzzy matches are only tried for names at least this long, short names are too ambiguous.
+    MIN_FUZZY_LENGTH = 5
+
+    _PUNCTUATION_REGEX = re.compile('[^\\w\\s&]', re.UNICODE)
+    _THE_REGEX = re.compile('(^|\\s)the(\\s|$)')
+    _SPACE_REGEX = re.compile('\\s+')
+
+    def __init__(self):
+        super(GameCatalogue, self).__init__()
+        self._games = dict()      # id: CatalogueGame
+        self._names = dict()      # normalized name: list of ids
+        self._trigrams = dict()   # trigram: set of normalized names
+
+    def __len__(self):
+        return len(self._games)
+
+    @classmethod
+    def normalize(cls, name):
+        name = name.lower().replace('&', ' and ')
+        name = cls._PUNCTUATION_REGEX.sub(' ', name)
+        name = cls._THE_REGEX.sub(' ', name)
+        return cls._SPACE_REGEX.sub(' ', name).strip()
+
+    @staticmethod
+    def _trigramsOf(name):
+        padded = '  {} '.format(name)
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def add(self, game, names):
+        self._games[game.id] = game
+        for name in names:
+            norm = self.normalize(name)
+            if not norm:
+                continue
+            ids = self._names.setdefault(norm, [])
+            if game.id not in ids:
+                ids.append(game.id)
+            for trigram in self._trigramsOf(norm):
+                self._trigrams.setdefault(trigram, set()).add(norm)
+
+    @classmethod
+    def load(cls, path):
+        '''Load a catalogue from a .csv or .xml file.'''
+        catalogue = cls()
+        if path.lower().endswith('.xml'):
+            catalogue._loadXML(path)
+        else:
+            catalogue._loadCSV(path)
+        log.info('Loaded {} games into the catalogue from {}'.format(len(catalogue), path))
+        return catalogue
+
+    @staticmethod
+    def _int(value):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+
+    def _loadCSV(self, path):
+        with open(path, newline='', encoding='utf-8') as fd:
+            for row in csv.DictReader(fd):
+                game = CatalogueGame(
+                    id=int(row['id']),
+                    name=row['name'],
+                    owned=self._int(row.get('owned', row.get('users_owned'))) or 0,
+                    rank=self._int(row.get('rank')) or None,
+                    expansion=row.get('is_expansion', '0') in ('1', 'true', 'True'))
+                alternates = [n for n in (row.get('alternate_names') or '').split('|') if n]
+                self.add(game, [game.name] + alternates)
+
+    def _loadXML(self, path):
+        for item in ElementTree.parse(path).getroot().iter('item'):
+            names = item.findall('name')
+            primary = [n.get('value') for n in names if n.get('type') == 'primary']
+            if not primary:
+                continue
+            owned = item.find('statistics/ratings/owned')
+            ranks = [r.get('value') for r in item.iter('rank') if r.get('name') == 'boardgame']
+            game = CatalogueGame(
+                id=int(item.get('id')),
+                name=primary[0],
+                owned=self._int(owned.get('value')) if owned is not None else 0,
+                rank=self._int(ranks[0]) if ranks else None,
+                expansion=item.get('type') == 'boardgameexpansion')
+            self.add(game, [n.get('value') for n in names])
+
+    def _best(self, ids):
+        '''Pick the game people most likely mean: not an expansion, most owned, best ranked.'''
+        games = [self._games[i] for i in ids]
+        return min(games, key=lambda g: (g.expansion, -(g.owned or 0), g.rank or float('inf'))).id
+
+    def resolve(self, name, fuzzy=True):
+        '''Return the BGG id for name, or None if nothing in the catalogue is close enough. With
+        fuzzy False only names that match once normalized are found, not misspelt ones.'''
+        norm = self.normalize(name)
+        if not norm:
+            return None
+
+        ids = self._names.get(norm)
+        if ids:
+            return self._best(ids)
+
+        if not fuzzy or len(norm) < self.MIN_FUZZY_LENGTH:
+            return None
+
+        # count shared trigrams to find a few candidates, then check those properly.
+        trigrams = self._trigramsOf(norm)
+        shared = dict()
+        for trigram in trigrams:
+            for candidate in self._trigrams.get(trigram, ()):
+                shared[candidate] = shared.get(candidate, 0) + 1
+
+        best = None
+        best_score = self.MIN_SIMILARITY
+        for candidate, count in sorted(shared.items(), key=lambda c: -c[1])[:20]:
+            score = SequenceMatcher(None, norm, candidate).ratio()
+            if score >= best_score:
+                best, best_score = candidate, score
+
+        if best:
+            log.debug('catalogue matched {} to {}'.format(name, best))
+            return self._best(self._names[best])
+
+        return None
@@ -0,0 +1,59 @@
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class GameRecord(object):
+    '''The parts of a boardgamegeek BoardGame the bot uses, copied out when the game is
+    fetched. Much smaller than the BoardGame object and cheap to serialize.'''
+    # bump when the fields change so old serialized records are ignored.
+    VERSION = 1
+
+    __slots__ = (
+        'id', 'name', 'year', 'designers', 'min_players', 'max_players', 'playing_time', 'image',
+        'mechanics', 'description', 'expansion', 'users_rated', 'users_owned', 'rating_average',
+        'rating_bayes_average', 'rating_median', 'rating_stddev', 'rating_average_weight',
+        'rating_num_weights', 'boardgame_rank', 'ranks'
+    )
+
+    def __init__(self, **fields):
+        for field in self.__slots__:
+            setattr(self, field, fields.get(field))
+
+    @property
+    def rank(self):
+        return self.boardgame_rank
+
+    @classmethod
+    def from_game(cls, game):
+        '''Copy what we need out of a boardgamegeek BoardGame.'''
+        record = cls(**{field: getattr(game, field, None) for field in cls.__slots__})
+        record.designers = tuple(record.designers or ())
+        record.mechanics = tuple(record.mechanics or ())
+        record.expansion = bool(record.expansion)
+        record.users_rated = record.users_rated or 0
+        record.ranks = tuple({'friendlyname': r['friendlyname'], 'value': r['value']}
+                             for r in (record.ranks or ()))
+        return record
+
+    def to_dict(self):
+        d = {field: getattr(self, field) for field in self.__slots__}
+        d['designers'] = list(self.designers)
+        d['mechanics'] = list(self.mechanics)
+        d['ranks'] = list(self.ranks)
+        d['v'] = self.VERSION
+        return d
+
+    @classmethod
+    def from_dict(cls, d):
+        '''Inverse of to_dict. Returns None for records serialized by another version.'''
+        if d.get('v') != cls.VERSION:
+            return None
+        record = cls(**d)
+        record.designers = tuple(record.designers)
+        record.mechanics = tuple(record.mechanics)
+        record.ranks = tuple(record.ranks)
+        return record
+
+    def __repr__(self):
+        return 'GameRecord({}, {!r})'.format(self.id, self.name)
@@ -0,0 +1,75 @@
+import logging
+from Metrics import metrics
+
+log = logging.getLogger(__name__)
+
+
+class InboxStream(object):
+    '''Reads the new items from the bot's inbox listings. Listings are read newest first and
+    lazily, a page at a time, and reading stops once it gets back to items that have already
+    been seen. An item in more than one listing is only returned once. Call commit() once the
+    items a poll returned are safely stored, or the next poll reads them again.'''
+    PAGE_SIZE = 100
+
+    def __init__(self, reddit, botdb):
+        super(InboxStream, self).__init__()
+        self._reddit = reddit
+        self._botdb = botdb
+        self._newest = dict()    # listing name: fullname of the newest item read last time.
+        self._pending = dict()   # the same, for the poll that isn't committed yet.
+
+    def _listings(self):
+        return [('mentions', self._reddit.inbox.mentions), ('unread', self._reddit.inbox.unread)]
+
+    def poll(self):
+        '''Return the inbox items not in the bot database, newest first.'''
+        items = dict()
+        self._pending = dict()
+        for name, listing in self._listings():
+            with metrics.timer('r2d8_inbox_poll_seconds', listing=name):
+                self._read(name, listing, items)
+
+        return list(items.values())
+
+    def commit(self):
+        '''Stop at the newest items of the last poll next time, now that they are stored.'''
+        self._newest.update(self._pending)
+        self._pending = dict()
+
+    def _read(self, name, listing, items):
+        stop_at = self._newest.get(name)
+        page = list()
+        read = 0
+        # limit=None lets PRAW page through the listing on demand, so breaking out of the loop
+        # early stops any further requests.
+        for item in listing(limit=None):
+            if read == 0:
+                self._pending[name] = item.fullname
+            read += 1
+            if item.fullname == stop_at:
+                break
+            if item.id in items:
+                continue
+
+            page.append(item)
+            if len(page) == self.PAGE_SIZE:
+                more = self._addNew(page, items)
+                page = list()
+                if not more:
+                    break
+
+        if page:
+            self._addNew(page, items)
+
+        metrics.inc('r2d8_inbox_items_read_total', read, listing=name)
+        log.debug('read {} items from {}'.format(read, name))
+
+    def _addNew(self, page, items):
+        '''Add the unseen items in page to items. Returns False if some were seen before, as
+        everything older than them will have been seen too.'''
+        with metrics.timer('r2d8_comment_check_seconds'):
+            new = self._botdb.new_comments(page)
+        for item in new:
+            items[item.id] = item
+
+        return len(new) == len(page)
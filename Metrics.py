@@ -0,0 +1,146 @@
+import logging
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter, sleep
+
+log = logging.getLogger(__name__)
+
+
+class Metrics(object):
+    '''Counters and timing histograms for the bot, exported in the Prometheus text format.
+    Metrics are identified by a name plus optional labels, e.g.
+    metrics.inc('r2d8_commands_total', command='getinfo').'''
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        super(Metrics, self).__init__()
+        self._buckets = tuple(buckets)
+        self._counters = dict()     # (name, labels): value
+        self._histograms = dict()   # (name, labels): [bucket counts..., sum, count]
+        self._collectors = list()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            hist = self._histograms.get(key)
+            if not hist:
+                hist = self._histograms[key] = [0] * (len(self._buckets) + 2)
+            hist[bisect_left(self._buckets, value)] += 1
+            hist[-2] += value
+            hist[-1] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        '''Time the with block, recording it in the name histogram.'''
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start, **labels)
+
+    def add_collector(self, fn):
+        '''fn is called at export time and returns a dict of name: value of gauges to export,
+        e.g. the game cache stats.'''
+        self._collectors.append(fn)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        labels = list(labels) + list(extra)
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(k, v) for k, v in labels) + '}'
+
+    def render(self):
+        '''All metrics in the Prometheus text exposition format.'''
+        lines = list()
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append('# TYPE {} counter'.format(name))
+                typed.add(name)
+            lines.append('{}{} {}'.format(name, self._labels(labels), value))
+
+        for (name, labels), hist in histograms:
+            if name not in typed:
+                lines.append('# TYPE {} histogram'.format(name))
+                typed.add(name)
+            total = 0
+            for bound, count in zip(self._buckets + ('+Inf',), hist[:-2]):
+                total += count
+                lines.append('{}_bucket{} {}'.format(name, self._labels(labels, [('le', bound)]), total))
+            lines.append('{}_sum{} {}'.format(name, self._labels(labels), hist[-2]))
+            lines.append('{}_count{} {}'.format(name, self._labels(labels), hist[-1]))
+
+        for fn in self._collectors:
+            for name, value in sorted(fn().items()):
+                lines.append('# TYPE {} gauge'.format(name))
+                lines.append('{} {}'.format(name, value))
+
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        '''A short human readable version of the metrics, one line per metric.'''
+        lines = list()
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                lines.append('{}{} {}'.format(name, self._labels(labels), value))
+            for (name, labels), hist in sorted(self._histograms.items()):
+                lines.append('{}{} count {} avg {:.3f}s'.format(
+                    name, self._labels(labels), hist[-1], hist[-2] / hist[-1] if hist[-1] else 0))
+        for fn in self._collectors:
+            for name, value in sorted(fn().items()):
+                lines.append('{} {}'.format(name, value))
+
+        return lines
+
+    def serve(self, port, host='127.0.0.1'):
+        '''Serve the metrics over HTTP at http://host:port/metrics from a background thread.'''
+        # http.server is slow to import and most runs don't serve metrics.
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                log.debug(format % args)
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        log.info('Serving metrics on http://{}:{}/metrics'.format(host, port))
+        return server
+
+    def dump_every(self, interval):
+        '''Log the metrics summary every interval seconds from a background thread.'''
+        def dump():
+            while True:
+                sleep(interval)
+                for line in self.summary():
+                    log.info(line)
+
+        threading.Thread(target=dump, name='metrics-dump', daemon=True).start()
+
+
+# everything in the process records into this.
+metrics = Metrics()
@@ -0,0 +1,49 @@
+import logging
+from time import time
+
+log = logging.getLogger(__name__)
+
+
+class PollScheduler(object):
+    '''Works out how long to wait before polling the inbox again. Polls at the minimum interval
+    while comments are arriving, backs off exponentially while the inbox is quiet or polling
+    fails, and never polls faster than reddit's rate limit allows.'''
+    QUIET_BACKOFF = 1.5
+    ERROR_BACKOFF = 2.0
+    # reddit requests made by a typical poll: a page each of mentions and unread.
+    REQUESTS_PER_POLL = 2
+
+    def __init__(self, min_interval, max_interval):
+        super(PollScheduler, self).__init__()
+        self._min = max(0, min_interval)
+        self._max = max(self._min, max_interval)
+        self._interval = self._min
+
+    def next_interval(self, new_items=0, error=False, limits=None):
+        '''Return the seconds to sleep after a poll that found new_items new comments. limits
+        is reddit's rate limit state as given by praw's reddit.auth.limits.'''
+        if error:
+            self._interval = max(1, self._interval) * self.ERROR_BACKOFF
+        elif new_items:
+            self._interval = self._min
+        else:
+            self._interval = max(1, self._interval) * self.QUIET_BACKOFF
+        self._interval = min(self._max, max(self._min, self._interval))
+
+        interval = max(self._interval, self._rateLimitInterval(limits))
+        log.debug('next poll in {:.1f}s'.format(interval))
+        return interval
+
+    def _rateLimitInterval(self, limits):
+        '''The shortest interval that spreads the remaining requests over the rest of the rate
+        limit window.'''
+        if not limits or limits.get('remaining') is None or not limits.get('reset_timestamp'):
+            return 0
+
+        window = max(0, limits['reset_timestamp'] - time())
+        polls = limits['remaining'] / self.REQUESTS_PER_POLL
+        if polls < 1:
+            log.warning('Out of reddit requests, waiting {:.0f}s for the rate limit to reset.'.format(window))
+            return window
+
+        return window / polls
@@ -0,0 +1,55 @@
+import logging
+import threading
+from time import sleep
+from Metrics import metrics
+
+log = logging.getLogger(__name__)
+
+
+class Prefetcher(object):
+    '''Background thread that refreshes the most asked for games in a GameCache shortly before
+    they expire, so nobody waits on BGG for a popular game. fetch(ids) returns fresh games for
+    the given ids; it should skip any HTTP cache and go through the BGG rate limiter. How often
+    a game was asked for counts half as much every half_life seconds, which should be on the
+    order of the cache's ttl, so a game asked for a few times a day stays hot.'''
+    def __init__(self, cache, fetch, interval=60, hot=500, ahead=3600, batch_size=20, max_batches=10,
+                 half_life=6 * 3600):
+        super(Prefetcher, self).__init__()
+        self._cache = cache
+        self._fetch = fetch
+        self._interval = interval
+        self._hot = hot
+        self._ahead = ahead
+        self._batch_size = batch_size
+        self._max_batches = max_batches
+        self._half_life = half_life
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='prefetch', daemon=True)
+        self._thread.start()
+        log.info('Started refreshing the {} most asked for games.'.format(self._hot))
+
+    def _run(self):
+        while True:
+            sleep(self._interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                log.error('Caught exception refreshing games: {}'.format(e))
+
+    def refresh(self):
+        '''Refresh the hot games that are about to expire. Returns how many were refreshed.'''
+        ids = self._cache.refresh_candidates(self._hot, self._ahead)
+        ids = ids[:self._batch_size * self._max_batches]
+        refreshed = 0
+        for start in range(0, len(ids), self._batch_size):
+            chunk = ids[start:start + self._batch_size]
+            log.debug('refreshing games {}'.format(chunk))
+            for game in self._fetch(chunk):
+                self._cache.put(game)
+                refreshed += 1
+
+        self._cache.decay_requests(self._half_life)
+        metrics.inc('r2d8_prefetch_refreshed_total', refreshed)
+        return refreshed
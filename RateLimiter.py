@@ -0,0 +1,102 @@
+import logging
+import sqlite3
+import threading
+from contextlib import closing
+from time import monotonic, sleep, time
+from requests.adapters import HTTPAdapter
+from Metrics import metrics
+
+log = logging.getLogger(__name__)
+
+
+class RateLimiter(object):
+    '''Token bucket. Allows bursts of up to capacity requests, then spaces requests out to
+    rate per second.'''
+    def __init__(self, rate, capacity=1):
+        super(RateLimiter, self).__init__()
+        self._rate = float(rate)
+        self._capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._last = monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''Take a token, sleeping until one is available. Returns the time spent waiting.'''
+        with self._lock:
+            now = monotonic()
+            self._tokens = min(self._capacity, self._tokens + (now - self._last) * self._rate)
+            self._last = now
+            # reserve the token now, even if we have to wait for it. This keeps waiting
+            # threads in order without holding the lock while sleeping.
+            self._tokens -= 1
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0
+
+        if wait > 0:
+            log.debug('rate limited, waiting {:.2f}s'.format(wait))
+            sleep(wait)
+
+        return wait
+
+
+class SharedRateLimiter(object):
+    '''Token bucket like RateLimiter, kept in the sqlite database at path so that every process
+    using the same database and name shares it.'''
+    def __init__(self, path, name, rate, capacity=1):
+        super(SharedRateLimiter, self).__init__()
+        self._path = path
+        self._name = name
+        self._rate = float(rate)
+        self._capacity = float(capacity)
+        with closing(self._connect()) as db:
+            db.execute('CREATE TABLE IF NOT EXISTS rate_limits (name text PRIMARY KEY, '
+                       'tokens real, last real)')
+            db.execute('INSERT OR IGNORE INTO rate_limits VALUES (?, ?, ?)',
+                       (name, self._capacity, time()))
+            db.commit()
+
+    def _connect(self):
+        # autocommit, so the transaction in acquire can be started by hand.
+        return sqlite3.connect(self._path, timeout=30, isolation_level=None)
+
+    def acquire(self):
+        '''Take a token, sleeping until one is available. Returns the time spent waiting.'''
+        # a connection per call, so any thread in any process can use the limiter.
+        with closing(self._connect()) as db:
+            # IMMEDIATE takes the write lock up front, so no other process takes the same token.
+            db.execute('BEGIN IMMEDIATE')
+            tokens, last = db.execute('SELECT tokens, last FROM rate_limits WHERE name=?',
+                                      (self._name,)).fetchone()
+            now = time()
+            tokens = min(self._capacity, tokens + max(0, now - last) * self._rate) - 1
+            db.execute('UPDATE rate_limits SET tokens=?, last=? WHERE name=?',
+                       (tokens, now, self._name))
+            db.execute('COMMIT')
+
+        wait = -tokens / self._rate if tokens < 0 else 0
+        if wait > 0:
+            log.debug('rate limited, waiting {:.2f}s'.format(wait))
+            sleep(wait)
+
+        return wait
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    '''requests transport adapter that takes a token from limiter before every request that
+    actually goes out on the network. Responses served from a requests cache never get here.'''
+    def __init__(self, limiter, **kwargs):
+        self._limiter = limiter
+        super(RateLimitedAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        metrics.observe('r2d8_bgg_rate_limit_wait_seconds', self._limiter.acquire())
+        # anything getting here missed the sqlite cache.
+        metrics.inc('r2d8_bgg_network_requests_total')
+        with metrics.timer('r2d8_bgg_network_seconds'):
+            return super(RateLimitedAdapter, self).send(request, **kwargs)
+
+
+# BGG asks that the XML API not be hammered. This is shared by everything in the process
+# talking to BGG; bot processes sharing a BGG cache use a SharedRateLimiter on it instead.
+BGG_REQUESTS_PER_SECOND = 2
+BGG_BURST = 4
+bgg_limiter = RateLimiter(BGG_REQUESTS_PER_SECOND, BGG_BURST)
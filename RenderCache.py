@@ -0,0 +1,48 @@
+import logging
+import threading
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+
+class RenderCache(object):
+    '''LRU cache of rendered markdown, keyed by (game id, mode, columns). An entry is only
+    used while the game object it was rendered from is still the current one, so refreshed
+    game data is always rendered again.'''
+    DEFAULT_SIZE = 2000
+
+    def __init__(self, max_entries=DEFAULT_SIZE):
+        super(RenderCache, self).__init__()
+        self._max_entries = max(1, max_entries)
+        self._entries = OrderedDict()   # key: (game, markdown), least recently used first.
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, game, mode, columns, fn):
+        '''Return fn(game), rendering it only if it is not cached for this game object.'''
+        key = (game.id, mode, tuple(columns) if columns else None)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] is game:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        markdown = fn(game)
+        with self._lock:
+            self._entries[key] = (game, markdown)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+        return markdown
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses
+            }
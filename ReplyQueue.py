@@ -0,0 +1,179 @@
+import heapq
+import logging
+import re
+import threading
+from itertools import count
+from time import sleep, time
+from Metrics import metrics
+
+log = logging.getLogger(__name__)
+
+_RATELIMIT_REGEX = re.compile('(\\d+) (millisecond|second|minute)', re.IGNORECASE)
+
+
+# reddit errors that the same write will always get, so there's no point trying again.
+PERMANENT_ERRORS = ('TOO_LONG', 'DELETED_COMMENT', 'THREAD_LOCKED', 'TOO_OLD',
+                    'NOT_WHITELISTED_BY_USER_MESSAGE')
+
+
+def _error_items(error):
+    # newer praw raises RedditAPIException with a list of items, older APIException is one item.
+    return getattr(error, 'items', None) or [error]
+
+
+def is_permanent(error):
+    '''True if error is a reddit error that retrying the write won't fix.'''
+    return any(getattr(item, 'error_type', None) in PERMANENT_ERRORS for item in _error_items(error))
+
+
+def ratelimit_delay(error):
+    '''If error is reddit's RATELIMIT error ("you are doing that too much. try again in 5
+    minutes."), return the seconds to wait before trying again, else None.'''
+    for item in _error_items(error):
+        if getattr(item, 'error_type', None) != 'RATELIMIT':
+            continue
+        m = _RATELIMIT_REGEX.search(getattr(item, 'message', '') or '')
+        if not m:
+            return 60
+        unit = m.group(2).lower()
+        scale = 60 if unit == 'minute' else 0.001 if unit == 'millisecond' else 1
+        return int(m.group(1)) * scale
+
+    return None
+
+
+class WriteGovernor(object):
+    '''Decides when the bot may next write to reddit. Writes are held while reddit says the
+    account is posting too much (a RATELIMIT error), and when the API rate limit, as given by
+    limits() (e.g. praw's reddit.auth.limits), is down to its last RESERVE requests, which are
+    kept for polling the inbox.'''
+    RESERVE = 10
+
+    def __init__(self, limits=None):
+        super(WriteGovernor, self).__init__()
+        self._limits = limits
+        self._until = 0
+
+    def throttle(self, seconds):
+        '''Hold all writes for seconds.'''
+        log.warning('reddit says we are posting too much, holding replies for {:.0f}s'.format(seconds))
+        metrics.inc('r2d8_reddit_ratelimited_total')
+        self._until = max(self._until, time() + seconds)
+
+    def delay(self):
+        '''Seconds until the next write may go out.'''
+        now = time()
+        delay = self._until - now
+        limits = self._limits() if self._limits else None
+        if limits and limits.get('remaining') is not None and limits.get('reset_timestamp'):
+            if limits['remaining'] <= self.RESERVE:
+                delay = max(delay, limits['reset_timestamp'] - now)
+
+        return max(0, delay)
+
+    def wait(self):
+        delay = self.delay()
+        if delay > 0:
+            log.info('waiting {:.0f}s before writing to reddit'.format(delay))
+            metrics.observe('r2d8_reply_wait_seconds', delay)
+            sleep(delay)
+
+
+class ReplyQueue(object):
+    '''Posts the bot's replies and edits from a background thread, as fast as governor allows,
+    most urgent first. Writes that hit reddit's RATELIMIT error are kept and tried again once
+    it has passed. Writes are queued with the job they are for, and priority(job) gives their
+    place in the queue. Once a job's writes are all done, done(job) is called, and if one fails
+    for any other reason failed(job, error) is.'''
+    INTERACTIVE = 0     # replies to someone waiting on the bot.
+    BULK = 1            # big, slow jobs that can wait their turn.
+    # a write is given up on after this many RATELIMIT errors.
+    MAX_RATELIMITS = 5
+
+    def __init__(self, governor, priority=None, done=None, failed=None):
+        super(ReplyQueue, self).__init__()
+        self._governor = governor
+        self._priority = priority
+        self._done = done
+        self._failed = failed
+        self._queue = list()    # heap of [priority, seq, write, job, ratelimits]
+        self._seq = count()
+        self._unfinished = 0
+        self._failedJobs = set()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def put(self, write, job=None):
+        '''Queue write, a function that does a single reply or edit.'''
+        priority = self._priority(job) if self._priority else self.INTERACTIVE
+        with self._cond:
+            heapq.heappush(self._queue, [priority, next(self._seq), write, job, 0])
+            self._unfinished += 1
+            self._cond.notify()
+
+    def finish(self, job):
+        '''Mark job as done once all the writes queued for it so far are done.'''
+        self.put(None, job)
+
+    def join(self):
+        '''Wait until everything queued has been written.'''
+        with self._cond:
+            while self._unfinished:
+                self._cond.wait()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='replies', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                item = heapq.heappop(self._queue)
+
+            requeue = self._write(item)
+            with self._cond:
+                if requeue:
+                    # it keeps its place in the queue.
+                    heapq.heappush(self._queue, item)
+                else:
+                    self._unfinished -= 1
+                    self._cond.notify_all()
+
+    def _write(self, item):
+        '''Do a queued write. Returns True if it has to be tried again.'''
+        priority, seq, write, job, ratelimits = item
+        if write is None:
+            if job in self._failedJobs:
+                self._failedJobs.discard(job)
+            elif self._done:
+                self._call(self._done, job)
+            return False
+
+        self._governor.wait()
+        try:
+            write()
+            metrics.inc('r2d8_replies_total',
+                        priority='interactive' if priority == self.INTERACTIVE else 'bulk')
+            return False
+        except Exception as e:
+            delay = ratelimit_delay(e)
+            if delay is not None and ratelimits < self.MAX_RATELIMITS:
+                item[4] += 1
+                self._governor.throttle(delay)
+                return True
+
+            log.error('Caught exception writing reply for {}: {}'.format(job.id if job else '', e))
+            if job:
+                self._failedJobs.add(job)
+                if self._failed:
+                    self._call(self._failed, job, e)
+            return False
+
+    @staticmethod
+    def _call(fn, *args):
+        try:
+            fn(*args)
+        except Exception as e:
+            log.error('Caught exception finishing reply: {}'.format(e))
@@ -0,0 +1,81 @@
+import logging
+import threading
+from concurrent.futures import Future
+from Metrics import metrics
+
+log = logging.getLogger(__name__)
+
+
+class SingleFlight(object):
+    '''Coalesces concurrent calls for the same key. The first caller for a key does the work,
+    anyone asking for that key while it's in flight waits for it and gets the same result, or
+    the same exception. Once the call is done the next caller starts afresh, so nothing is
+    cached here. name labels the r2d8_coalesced_total metric.'''
+    def __init__(self, name):
+        super(SingleFlight, self).__init__()
+        self._name = name
+        self._calls = dict()    # key: Future for the call in flight
+        self._lock = threading.Lock()
+
+    def _claim(self, keys):
+        '''Split keys into the ones the caller has to fetch, each given a new Future, and the
+        ones already in flight.'''
+        lead = dict()
+        wait = dict()
+        with self._lock:
+            for key in keys:
+                future = self._calls.get(key)
+                if future is None:
+                    lead[key] = self._calls[key] = Future()
+                else:
+                    wait[key] = future
+
+        if wait:
+            metrics.inc('r2d8_coalesced_total', len(wait), flight=self._name)
+        return lead, wait
+
+    def _release(self, futures, results=None, error=None):
+        with self._lock:
+            for key in futures:
+                del self._calls[key]
+        for key, future in futures.items():
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(results.get(key))
+
+    def do(self, key, fn, *args):
+        '''Return fn(*args), unless a call for key is already in flight, in which case wait for
+        it and return its result.'''
+        lead, wait = self._claim([key])
+        if wait:
+            log.debug('waiting for {} already in flight'.format(key))
+            return wait[key].result()
+
+        try:
+            result = fn(*args)
+        except Exception as e:
+            self._release(lead, error=e)
+            raise
+
+        self._release(lead, {key: result})
+        return result
+
+    def do_many(self, keys, fn):
+        '''Like do, for many keys at once. fn(keys) is only called with the keys not already in
+        flight and returns a dict of key: result. Returns a dict of key: result for all keys,
+        with None for keys fn had no result for.'''
+        lead, wait = self._claim(dict.fromkeys(keys))
+        results = dict()
+        if lead:
+            try:
+                results = fn(list(lead))
+            except Exception as e:
+                self._release(lead, error=e)
+                raise
+            self._release(lead, results)
+
+        results = {key: results.get(key) for key in lead}
+        for key, future in wait.items():
+            results[key] = future.result()
+        return results
@@ -1,22 +1,204 @@
 import argparse
-import praw
+import atexit
 import logging
 import re
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from time import sleep
-from html.parser import HTMLParser 
+from html import unescape
+import multiprocessing
+from queue import Empty
 from argParseLog import addLoggingArgs, handleLoggingArgs
 from BotDatabase import BotDatabase
 from CommentHandler import CommentHandler
+from GameCache import GameCache
+from GameCatalogue import GameCatalogue
+from InboxStream import InboxStream
+from PollScheduler import PollScheduler
+from ReplyQueue import ReplyQueue, WriteGovernor, is_permanent
+from Metrics import metrics
 
 from r2d8_oauth import login as oauth_login
 
 log = logging.getLogger(__name__)
 
+# how often idle worker processes look for jobs that are due to be retried, in seconds.
+JOB_CHECK_INTERVAL = 10
+# max number of polled inbox items kept around for their jobs, so they needn't be fetched again.
+ITEM_CACHE_SIZE = 1000
+# commands whose replies wait behind everyone else's, as they're big and nobody expects them fast.
+BULK_COMMANDS = ('getthreadinfo',)
+
+
+def command_regex(botname):
+    return re.compile('/?u/{}\s(\w+)((?:\s\w+)*)'.format(botname), re.IGNORECASE)
+
+
+def make_dispatcher(ch, botname, config):
+    '''Return a function that runs every bot command found in a comment.'''
+    CMDMAP = {
+        'getinfo': ch.getInfo,
+        'repair': ch.repairComment,
+        'xyzzy': ch.xyzzy,
+        'alias': ch.alias,
+        'getaliases': ch.getaliases,
+        'getparentinfo': ch.getParentInfo,
+        'getinfoparent': ch.getParentInfo,
+        'getthreadinfo': ch.getThreadInfo,
+        'expandurls': ch.expandURLs,
+        'tryagain': ch.removalRequest,
+        'shame': ch.removalRequest
+    }
+    BOTCMD_REGEX = command_regex(botname)
+
+    def dispatch(comment, commands=None):
+        commands = commands if commands else BOTCMD_REGEX.findall(comment.body)
+        for cmd in commands:
+            primaryCommand = cmd[0].lower()
+            if primaryCommand in CMDMAP:
+                comment.body = unescape(comment.body)
+                metrics.inc('r2d8_commands_total', command=primaryCommand)
+                with metrics.timer('r2d8_command_seconds', command=primaryCommand):
+                    CMDMAP[primaryCommand](
+                        comment,
+                        subcommands=cmd[1].split(),
+                        config=config)
+            else:
+                log.info('Got unknown command: {}'.format(primaryCommand))
+
+    return dispatch
+
+
+def make_handler(args, botname, bdb, prefetch=False, game_cache_file=None):
+    catalogue = GameCatalogue.load(args.catalogue) if args.catalogue else None
+    ch = CommentHandler(botname, bdb, lookup_threads=args.lookup_threads,
+                        game_cache_size=args.game_cache_size, catalogue=catalogue,
+                        game_cache_file=game_cache_file, prefetch=prefetch,
+                        bgg_timeout=(args.bgg_connect_timeout, args.bgg_read_timeout),
+                        shared_bgg=args.processes > 0)
+    log.info('Comment/notification handler created.')
+    return ch
+
+
+def quiet_libraries():
+    # quiet requests
+    logging.getLogger("requests").setLevel(logging.WARNING)
+    logging.getLogger("prawcore").setLevel(logging.WARNING)
+    logging.getLogger("urllib3").setLevel(logging.WARNING)
+
+
+def job_metrics(bdb):
+    '''Report the number of jobs in each state from the bot database bdb.'''
+    metrics.add_collector(lambda: {'r2d8_jobs_' + k: v for k, v in bdb.job_counts().items()})
+
+
+def login(args):
+    return oauth_login(config_file_path = args.config) if args.config else oauth_login()
+
+
+def reddit_per_thread(connect):
+    '''Return a function that gives each thread its own Reddit, made by connect(), as a praw
+    Reddit must not be used by several threads at once.'''
+    local = threading.local()
+
+    def get():
+        if not hasattr(local, 'reddit'):
+            local.reddit = connect()
+        return local.reddit
+    return get
+
+
+def load_item(reddit, fullname):
+    '''The inbox item, a comment or a private message, with the given fullname.'''
+    kind, item_id = fullname.split('_', 1)
+    return reddit.inbox.message(item_id) if kind == 't4' else reddit.comment(item_id)
+
+
+def rebind(reddit, target):
+    '''The comment, submission, message or redditor target, loaded through reddit instead of
+    the Reddit it came from.'''
+    from praw.models import Comment, Message, Redditor, Submission
+    if isinstance(target, Comment):
+        return reddit.comment(target.id)
+    if isinstance(target, Submission):
+        return reddit.submission(target.id)
+    if isinstance(target, Message):
+        return reddit.inbox.message(target.id)
+    if isinstance(target, Redditor):
+        return reddit.redditor(target.name)
+    return target
+
+
+def is_temporary(error, bgg_error):
+    '''True if error may go away when the command is tried again: BGG, reddit or the network
+    failing, or the database being busy. bgg_error is the exception the BGG client raises.'''
+    from prawcore.exceptions import PrawcoreException
+    from requests.exceptions import RequestException
+    if isinstance(error, sqlite3.OperationalError):
+        return 'locked' in str(error)
+    return isinstance(error, (bgg_error, PrawcoreException, RequestException, ConnectionError,
+                              TimeoutError))
+
+
+def run_job(job, load, dispatch, ch, bdb):
+    '''Run a job's command on the inbox item load(job.id). Returns True if it worked. If it
+    didn't, the job is queued to be tried again later, unless trying again can't help.'''
+    ch.setJob(job)
+    try:
+        dispatch(load(job.id), [(job.command, job.subcommands)])
+    except Exception as e:
+        log.error('Caught exception handling {}: {}'.format(job.id, e))
+        metrics.inc('r2d8_job_failures_total', command=job.command)
+        bdb.retry_job(job, e, permanent=not is_temporary(e, ch.bggError()))
+        return False
+    finally:
+        ch.setJob(None)
+
+    return True
+
+
+def make_reply_queue(ch, bdb, reddit):
+    '''Start a ReplyQueue to post ch's replies and edits, at the pace reddit allows. reddit is
+    only used by the queue's thread, which posts through it. A job is finished once its replies
+    are posted, or queued to be tried again if they fail.'''
+    def priority(job):
+        return ReplyQueue.BULK if job and job.command in BULK_COMMANDS else ReplyQueue.INTERACTIVE
+
+    replies = ReplyQueue(WriteGovernor(lambda: reddit.auth.limits), priority,
+                         done=lambda job: finish_job(job, bdb),
+                         failed=lambda job, e: bdb.retry_job(job, e, permanent=is_permanent(e)))
+
+    def queued(write):
+        def put(target, body, **kwargs):
+            # the job is only known in the thread running it.
+            job = ch.currentJob()
+            replies.put(lambda: write(rebind(reddit, target), body, job=job, **kwargs), job)
+        return put
+
+    ch.replier = queued(ch._postReply)
+    ch.editor = queued(ch._postEdit)
+    ch.messenger = queued(ch._postMessage)
+    replies.start()
+    return replies
+
+
+def finish_job(job, bdb):
+    if bdb.finish_job(job) and job.attempts > 1:
+        # a retry worked, so whatever was failing is back. Don't make the rest of the backlog
+        # wait out their backoff.
+        released = bdb.retry_now()
+        if released:
+            log.info('{} retried ok, retrying {} waiting jobs now'.format(job.id, released))
+
+
 def start_bot():
     ap = argparse.ArgumentParser()
     botname = 'r2d8'
     dbname = '{}-bot.db'.format(botname)
     sleepTime = 5
+    maxSleepTime = 120
+    workers = 4
 
     ap.add_argument(
         '-d',
@@ -32,9 +214,16 @@ def start_bot():
     ap.add_argument(
         '-s',
         '--sleep',
-        help='Time to sleep between API checks. Default is {} seconds.'.format(sleepTime),
+        help='Shortest time to sleep between API checks, used while comments are arriving. '
+             'Default is {} seconds.'.format(sleepTime),
         default=sleepTime,
         type=int)
+    ap.add_argument(
+        '--max-sleep',
+        help='Longest time to sleep between API checks when the inbox is quiet or reddit is '
+             'failing. Default is {} seconds.'.format(maxSleepTime),
+        default=maxSleepTime,
+        type=int)
     ap.add_argument(
         '-o',
         '--once',
@@ -59,6 +248,69 @@ def start_bot():
         '--footer',
         help='Custom footer to append to the message',
         default='')
+    ap.add_argument(
+        '--lookup-threads',
+        help='Max number of concurrent BGG lookups, shared by all the commands a process runs. '
+             'Default is {}.'.format(
+            CommentHandler.DEFAULT_LOOKUP_THREADS),
+        default=CommentHandler.DEFAULT_LOOKUP_THREADS,
+        type=int)
+    ap.add_argument(
+        '--bgg-connect-timeout',
+        help='Seconds to wait for a connection to BGG. Default is {}.'.format(
+            CommentHandler.BGG_CONNECT_TIMEOUT),
+        default=CommentHandler.BGG_CONNECT_TIMEOUT,
+        type=float)
+    ap.add_argument(
+        '--bgg-read-timeout',
+        help='Seconds to wait for BGG to answer. Default is {}.'.format(
+            CommentHandler.BGG_READ_TIMEOUT),
+        default=CommentHandler.BGG_READ_TIMEOUT,
+        type=float)
+    ap.add_argument(
+        '--game-cache-size',
+        help='Number of BGG games kept in memory. Default is {}.'.format(GameCache.DEFAULT_SIZE),
+        default=GameCache.DEFAULT_SIZE,
+        type=int)
+    ap.add_argument(
+        '--game-cache-file',
+        help='Keep the in memory game cache in this file between runs.',
+        default=None)
+    ap.add_argument(
+        '--catalogue',
+        help='BGG catalogue dump (.csv or .xml) used to find game names without asking BGG.',
+        default=None)
+    ap.add_argument(
+        '--metrics-port',
+        help='Serve Prometheus metrics on this localhost port. Off by default. With --processes '
+             'this only has the polling process\'s metrics, worker N serves its own on the '
+             'port N + 1 above it.',
+        default=None,
+        type=int)
+    ap.add_argument(
+        '--stats-interval',
+        help='Log a summary of the bot metrics every this many seconds. Off by default.',
+        default=None,
+        type=int)
+    ap.add_argument(
+        '-a',
+        '--async',
+        help='Poll, run commands and post replies concurrently instead of one at a time.',
+        action='store_true',
+        dest='use_async')
+    ap.add_argument(
+        '-p',
+        '--processes',
+        help='Run commands in this many worker processes, fed by a single polling process. '
+             'Off by default.',
+        default=0,
+        type=int)
+    ap.add_argument(
+        '-w',
+        '--workers',
+        help='Number of commands run at the same time in async mode. Default is {}.'.format(workers),
+        default=workers,
+        type=int)
     addLoggingArgs(ap)
     args = ap.parse_args()
     handleLoggingArgs(args)
@@ -66,34 +318,17 @@ def start_bot():
     dbname = args.database if args.database else dbname
     sleepTime = args.sleep if args.sleep else sleepTime
 
-    hp = HTMLParser()
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    if args.stats_interval:
+        metrics.dump_every(args.stats_interval)
 
-    # quiet requests
-    logging.getLogger("requests").setLevel(logging.WARNING)
-    logging.getLogger("prawcore").setLevel(logging.WARNING)
-    logging.getLogger("urllib3").setLevel(logging.WARNING)
+    quiet_libraries()
 
-    reddit = oauth_login(config_file_path = args.config) if args.config else oauth_login()
+    reddit = login(args)
 
     bdb = BotDatabase(args.database)
     log.info('Bot database opened/created.')
-    ch = CommentHandler(botname, bdb)
-    log.info('Comment/notification handler created.')
-
-    CMDMAP = {
-        'getinfo': ch.getInfo,
-        'repair': ch.repairComment,
-        'xyzzy': ch.xyzzy,
-        'alias': ch.alias,
-        'getaliases': ch.getaliases,
-        'getparentinfo': ch.getParentInfo,
-        'getinfoparent': ch.getParentInfo,
-#        'getthreadinfo': ch.getThreadInfo,
-        'expandurls': ch.expandURLs,
-        'tryagain': ch.removalRequest,
-        'shame': ch.removalRequest
-    }
-    BOTCMD_REGEX = re.compile('/?u/{}\s(\w+)((?:\s\w+)*)'.format(botname), re.IGNORECASE)
 
     CONFIG = {
         'footer': args.footer
@@ -107,48 +342,228 @@ def start_bot():
             bdb.add_comment(comment)
             if args.mark_read:
                 return
-        commands = [args.command.split()] if args.command else BOTCMD_REGEX.findall(comment.body)
-        for cmd in commands:
-            primaryCommand = cmd[0].lower()
-            if primaryCommand in CMDMAP:
-                comment.body = hp.unescape(comment.body)
-                CMDMAP[primaryCommand](
-                    comment,
-                    subcommands=cmd[1].split(),
-                    config=CONFIG)
-            else:
-                log.info('Got unknown command: {}'.format(primaryCommand))
+        dispatch = make_dispatcher(make_handler(args, botname, bdb), botname, CONFIG)
+        dispatch(comment, [args.command.split()] if args.command else None)
         return
 
+    inbox = InboxStream(reddit, bdb)
+
+    # nothing gets answered, so skip setting up the comment handler.
+    if args.mark_read:
+        new_comments = inbox.poll()
+        bdb.add_comments(new_comments, reddit.inbox)
+        inbox.commit()
+        log.info('Marked {} items read.'.format(len(new_comments)))
+        return
+
+    # worker processes make their own comment handlers.
+    ch = None
+    if not args.processes:
+        ch = make_handler(args, botname, bdb, prefetch=not args.once,
+                          game_cache_file=args.game_cache_file)
+        atexit.register(ch.saveGameCache)
+        dispatch = make_dispatcher(ch, botname, CONFIG)
+        replies = make_reply_queue(ch, bdb, login(args))
+
+    BOTCMD_REGEX = command_regex(botname)
+    job_metrics(bdb)
+    items = dict()
+
+    def poll():
+        '''Return the inbox items we have not seen before, marking them as seen and queueing
+        jobs for their commands.'''
+        new_comments = inbox.poll()
+        log.debug('got {}'.format(', '.join(c.id for c in new_comments)))
+        # queue the jobs before marking the comments read, so a crash in between can't lose a
+        # request.
+        bdb.add_jobs([(c.fullname, BOTCMD_REGEX.findall(c.body)) for c in new_comments])
+        items.update((c.fullname, c) for c in new_comments)
+        for fullname in list(items)[:-ITEM_CACHE_SIZE]:
+            del items[fullname]
+        bdb.add_comments(new_comments, reddit.inbox)
+        # only now can the next poll stop at these items.
+        inbox.commit()
+        metrics.inc('r2d8_comments_total', len(new_comments))
+        if new_comments and ch:
+            log.info('game cache: {}'.format(ch.cacheStats()))
+        return new_comments
+
+    scheduler = PollScheduler(sleepTime, args.max_sleep)
+
+    def next_poll(new_items, error):
+        return scheduler.next_interval(new_items, error, reddit.auth.limits)
+
+    def load(fullname):
+        return items.get(fullname) or load_item(reddit, fullname)
+
+    if args.processes:
+        run_processes(args, botname, poll, next_poll)
+        exit(0)
+
+    if args.use_async:
+        import asyncio
+        # the commands run on several threads, so each loads its items with its own Reddit.
+        threadReddit = reddit_per_thread(lambda: login(args))
+        asyncio.run(run_async(ch, bdb, replies, poll,
+                              lambda fullname: load_item(threadReddit(), fullname), dispatch,
+                              next_poll, args.workers, args.once))
+        exit(0)
+
     log.info('Waiting for new PMs and/or notifications.')
     while True:
+        new_comments = list()
+        error = False
         try:
-            for comment in list(reddit.inbox.mentions()) + list(reddit.inbox.unread()):
-                log.debug('got {}'.format(comment.id))
-                if not bdb.comment_exists(comment):
-                    bdb.add_comment(comment)
-                    if args.mark_read:
-                        continue
-
-                    for cmd in BOTCMD_REGEX.findall(comment.body):
-                        primaryCommand = cmd[0].lower()
-                        if primaryCommand in CMDMAP:
-                            comment.body = hp.unescape(comment.body)
-                            CMDMAP[primaryCommand](
-                                comment,
-                                subcommands=cmd[1].split(),
-                                config=CONFIG)
-                        else:
-                            log.info('Got unknown command: {}'.format(primaryCommand))
-
+            new_comments = poll()
         except Exception as e:
             log.error('Caught exception: {}'.format(e))
+            error = True
+
+        # run everything that's due, which includes earlier failures whose backoff is up.
+        jobs = bdb.claim_jobs('main')
+        while jobs:
+            if run_job(jobs[0], load, dispatch, ch, bdb):
+                replies.finish(jobs[0])
+            jobs = bdb.claim_jobs('main')
 
         # get_mentions is non-blocking
-        if args.mark_read or args.once:
+        if args.once:
+            replies.join()
             exit(0)
 
-        sleep(sleepTime)
+        sleep(next_poll(len(new_comments), error))
+
+
+async def run_async(ch, bdb, replies, poll, load, dispatch, next_poll, workers, once=False):
+    '''Run the bot as three concurrent stages: inbox polling, command execution on a pool of
+    worker threads, and reply posting by the ReplyQueue replies. A slow command only holds up
+    its own worker. load(fullname) gives the inbox item for a job, and is called from the worker
+    threads, so it mustn't share a Reddit between them. next_poll(new_items, error) gives the
+    time to wait between polls.'''
+    import asyncio
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='command')
+    commands = asyncio.Queue(maxsize=max(1, workers) * 4)
+
+    async def poller():
+        log.info('Waiting for new PMs and/or notifications.')
+        while True:
+            new_comments = list()
+            error = False
+            try:
+                new_comments = await loop.run_in_executor(None, poll)
+            except Exception as e:
+                log.error('Caught exception: {}'.format(e))
+                error = True
+
+            while True:
+                jobs = await loop.run_in_executor(None, bdb.claim_jobs, 'async', workers)
+                if not jobs:
+                    break
+                for job in jobs:
+                    await commands.put(job)
+
+            if once:
+                return
+
+            await asyncio.sleep(next_poll(len(new_comments), error))
+
+    async def worker():
+        while True:
+            job = await commands.get()
+            try:
+                if await loop.run_in_executor(executor, run_job, job, load, dispatch, ch, bdb):
+                    replies.finish(job)
+            finally:
+                commands.task_done()
+
+    stages = [asyncio.create_task(worker()) for _ in range(max(1, workers))]
+    try:
+        await poller()
+        # only get here when running once. Let the queued work finish first.
+        await commands.join()
+        await loop.run_in_executor(None, replies.join)
+    finally:
+        for stage in stages:
+            stage.cancel()
+        executor.shutdown(wait=False)
+
+
+def run_processes(args, botname, poll, next_poll):
+    '''Poll the inbox in this process, queueing jobs for worker processes to run. The queue
+    just wakes the workers up, they claim the jobs from the bot database.'''
+    # spawned rather than forked: a forked worker would inherit this process's sqlite
+    # connection, reddit session and metrics thread, none of which survive a fork.
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    workers = [context.Process(target=work, args=(args, botname, queue, i),
+                               name='worker-{}'.format(i), daemon=True)
+               for i in range(args.processes)]
+    for w in workers:
+        w.start()
+
+    log.info('Waiting for new PMs and/or notifications.')
+    while True:
+        new_comments = list()
+        error = False
+        try:
+            new_comments = poll()
+        except Exception as e:
+            log.error('Caught exception: {}'.format(e))
+            error = True
+
+        for _ in range(min(len(new_comments), args.processes)):
+            queue.put(True)
+
+        if args.once:
+            break
+
+        sleep(next_poll(len(new_comments), error))
+
+    # tell the workers to finish up.
+    for w in workers:
+        queue.put(None)
+    for w in workers:
+        w.join()
+
+
+def work(args, botname, queue, index):
+    '''Worker process number index. Runs jobs from the bot database whenever woken up by queue,
+    and every JOB_CHECK_INTERVAL seconds for retries, until it gets None.'''
+    name = 'worker-{}'.format(index)
+    handleLoggingArgs(args)
+    quiet_libraries()
+    if args.metrics_port:
+        metrics.serve(args.metrics_port + index + 1)
+    if args.stats_interval:
+        metrics.dump_every(args.stats_interval)
+    reddit = login(args)
+    bdb = BotDatabase(args.database)
+    job_metrics(bdb)
+    # refreshes only reach this worker's in memory cache, so every worker keeps its own fresh.
+    # They all share the BGG rate limit, so together they can't ask BGG any more often.
+    ch = make_handler(args, botname, bdb, prefetch=not args.once)
+    dispatch = make_dispatcher(ch, botname, {'footer': args.footer})
+    replies = make_reply_queue(ch, bdb, login(args))
+    log.info('{} started'.format(name))
+
+    while True:
+        try:
+            wakeup = queue.get(timeout=JOB_CHECK_INTERVAL)
+        except Empty:
+            wakeup = True
+
+        # one job at a time, so the work is spread over all the workers.
+        jobs = bdb.claim_jobs(name)
+        while jobs:
+            if run_job(jobs[0], lambda fullname: load_item(reddit, fullname), dispatch, ch, bdb):
+                replies.finish(jobs[0])
+            jobs = bdb.claim_jobs(name)
+
+        if wakeup is None:
+            replies.join()
+            return
+
 
 if "__main__" == __name__:
     start_bot()
@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+'''Offline benchmark of the bot's hot paths.
+
+Runs the comment handlers against a stand-in BGG client and a stand-in reddit inbox, so
+nothing goes out on the network. BGG data comes from recorded XML API responses, e.g.
+
+    curl 'https://boardgamegeek.com/xmlapi2/thing?id=174430,167791&stats=1' > bench/top.xml
+
+in the --recordings directory, or is made up when there are none. Each BGG call sleeps
+--latency milliseconds to stand in for the network.
+
+    python3 benchmark.py --comments 200 --latency 50 > bench_output.txt
+
+With --startup it instead checks that importing the bot stays within IMPORT_BUDGET and doesn't
+pull in any of the SLOW_IMPORTS, exiting with an error if it does.
+'''
+import argparse
+import logging
+import random
+import subprocess
+import sys
+import threading
+from glob import glob
+from os.path import abspath, dirname, join as pjoin
+from time import perf_counter, sleep
+from xml.etree import ElementTree
+from argParseLog import addLoggingArgs, handleLoggingArgs
+from BotDatabase import BotDatabase
+from CommentHandler import CommentHandler
+from InboxStream import InboxStream
+
+log = logging.getLogger(__name__)
+
+# seconds a fresh interpreter may take to import the bot. Short --once runs are mostly startup.
+IMPORT_BUDGET = 0.25
+# modules that must only be imported once they're actually used.
+SLOW_IMPORTS = ('praw', 'prawcore', 'boardgamegeek', 'requests', 'asyncio', 'http.server')
+
+
+class FakeGame(object):
+    '''The parts of boardgamegeek.games.BoardGame the bot reads.'''
+    def __init__(self, **kwargs):
+        self.id = None
+        self.name = None
+        self.alternative_names = []
+        self.year = None
+        self.designers = []
+        self.min_players = None
+        self.max_players = None
+        self.playing_time = None
+        self.image = None
+        self.mechanics = []
+        self.description = ''
+        self.expansion = False
+        self.users_rated = 0
+        self.users_owned = 0
+        self.rating_average = 0
+        self.rating_bayes_average = 0
+        self.rating_median = 0
+        self.rating_stddev = 0
+        self.rating_average_weight = 0
+        self.rating_num_weights = 0
+        self.boardgame_rank = None
+        self.ranks = []
+        self.__dict__.update(kwargs)
+
+    @property
+    def rank(self):
+        return self.boardgame_rank
+
+
+class FakeSearchResult(object):
+    def __init__(self, game):
+        self.id = game.id
+        self.name = game.name
+        self.type = 'boardgameexpansion' if game.expansion else 'boardgame'
+
+
+def _value(item, path, default=None, cast=str):
+    node = item.find(path)
+    if node is None or node.get('value') in (None, ''):
+        return default
+    try:
+        return cast(node.get('value'))
+    except ValueError:
+        return default
+
+
+def load_recordings(path):
+    '''Read games from recorded BGG XML API thing responses (with stats=1).'''
+    games = list()
+    for fname in sorted(glob(pjoin(path, '*.xml'))):
+        for item in ElementTree.parse(fname).getroot().iter('item'):
+            ranks = [{'friendlyname': r.get('friendlyname'), 'value': r.get('value')}
+                     for r in item.iter('rank')]
+            rank = [r['value'] for r in ranks if r['friendlyname'] == 'Board Game Rank']
+            links = item.findall('link')
+            games.append(FakeGame(
+                id=int(item.get('id')),
+                name=[n.get('value') for n in item.findall('name') if n.get('type') == 'primary'][0],
+                alternative_names=[n.get('value') for n in item.findall('name')
+                                   if n.get('type') == 'alternate'],
+                year=_value(item, 'yearpublished', cast=int),
+                designers=[l.get('value') for l in links if l.get('type') == 'boardgamedesigner'],
+                mechanics=[l.get('value') for l in links if l.get('type') == 'boardgamemechanic'],
+                min_players=_value(item, 'minplayers', cast=int),
+                max_players=_value(item, 'maxplayers', cast=int),
+                playing_time=_value(item, 'playingtime', cast=int),
+                image=item.findtext('image'),
+                description=item.findtext('description') or '',
+                expansion=item.get('type') == 'boardgameexpansion',
+                users_rated=_value(item, 'statistics/ratings/usersrated', 0, int),
+                users_owned=_value(item, 'statistics/ratings/owned', 0, int),
+                rating_average=_value(item, 'statistics/ratings/average', 0, float),
+                rating_bayes_average=_value(item, 'statistics/ratings/bayesaverage', 0, float),
+                rating_median=_value(item, 'statistics/ratings/median', 0, float),
+                rating_stddev=_value(item, 'statistics/ratings/stddev', 0, float),
+                rating_average_weight=_value(item, 'statistics/ratings/averageweight', 0, float),
+                rating_num_weights=_value(item, 'statistics/ratings/numweights', 0, int),
+                boardgame_rank=int(rank[0]) if rank and rank[0].isdigit() else None,
+                ranks=ranks))
+
+    return games
+
+
+def make_games(count, rnd):
+    '''Make up some games that look enough like the real thing.'''
+    words = ['Castles', 'Dragons', 'Trains', 'Farmers', 'Dice', 'Empire', 'Space', 'Island',
+             'Kingdom', 'Harbor', 'Forest', 'Quest', 'Legends', 'Ticket', 'Merchants', 'Stars']
+    games = list()
+    for i in range(count):
+        name = ' '.join(rnd.sample(words, rnd.randint(1, 3)))
+        if rnd.random() < 0.2:
+            name = 'The ' + name
+        games.append(FakeGame(
+            id=1000 + i,
+            name='{} {}'.format(name, i),
+            year=rnd.randint(1990, 2020),
+            designers=['Designer {}'.format(rnd.randint(1, 50))],
+            min_players=rnd.randint(1, 2),
+            max_players=rnd.randint(2, 6),
+            playing_time=rnd.choice([30, 45, 60, 90, 120]),
+            image='https://example.com/{}.jpg'.format(i),
+            mechanics=rnd.sample(['Worker Placement', 'Deck Building', 'Drafting', 'Auction'], 2),
+            description='A game about {}. '.format(name.lower()) * 40,
+            expansion=rnd.random() < 0.1,
+            users_rated=rnd.randint(1, 50000),
+            users_owned=rnd.randint(1, 80000),
+            rating_average=round(rnd.uniform(5, 9), 2),
+            rating_bayes_average=round(rnd.uniform(5, 8), 2),
+            rating_median=0,
+            rating_stddev=round(rnd.uniform(1, 2), 2),
+            rating_average_weight=round(rnd.uniform(1, 4), 2),
+            rating_num_weights=rnd.randint(1, 2000),
+            boardgame_rank=i + 1,
+            ranks=[{'friendlyname': 'Board Game Rank', 'value': i + 1}]))
+
+    return games
+
+
+class FakeSession(object):
+    def mount(self, prefix, adapter):
+        pass
+
+
+class FakeBGGError(Exception):
+    '''Stands in for boardgamegeek.exceptions.BoardGameGeekError.'''
+
+
+class FakeBGG(object):
+    '''Stands in for boardgamegeek.BoardGameGeek, answering from a fixed set of games. Every
+    call sleeps for latency seconds and is counted.'''
+    SEARCH_BOARD_GAME = 'boardgame'
+
+    def __init__(self, games, latency=0.0):
+        self._games = {g.id: g for g in games}
+        self._names = dict()
+        for g in games:
+            for name in [g.name] + list(g.alternative_names):
+                self._names.setdefault(name.lower(), g)
+        self._latency = latency
+        self._lock = threading.Lock()
+        self.requests_session = FakeSession()
+        self.calls = 0
+
+    def _call(self):
+        with self._lock:
+            self.calls += 1
+        if self._latency:
+            sleep(self._latency)
+
+    def game(self, name=None, game_id=None, **kwargs):
+        self._call()
+        if game_id is not None:
+            return self._games.get(int(game_id))
+        return self._names.get(name.lower()) if name else None
+
+    def game_list(self, game_id_list=[], **kwargs):
+        self._call()
+        return [self._games[int(i)] for i in game_id_list if int(i) in self._games]
+
+    def search(self, query, search_type=None, exact=False):
+        self._call()
+        query = query.lower()
+        if exact:
+            return [FakeSearchResult(g) for name, g in self._names.items() if name == query]
+        return [FakeSearchResult(g) for name, g in self._names.items() if query in name]
+
+
+class FakeAuthor(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeSubreddit(object):
+    def __init__(self, name):
+        self.display_name = name
+
+
+class FakeInbox(object):
+    def __init__(self, comments):
+        self._comments = comments
+
+    def mentions(self, **kwargs):
+        return iter(self._comments)
+
+    def unread(self, **kwargs):
+        return iter(c for c in self._comments if not c.read)
+
+    def mark_read(self, items):
+        for c in items:
+            c.read = True
+
+
+class FakeReddit(object):
+    def __init__(self, comments):
+        self.inbox = FakeInbox(comments)
+
+
+class FakeComment(object):
+    '''Stands in for praw.models.Comment.'''
+    def __init__(self, cid, body, author='someone', subreddit='boardgames', parent=None):
+        self.id = cid
+        self.fullname = 't1_' + cid
+        self.body = body
+        self.author = FakeAuthor(author)
+        self.subreddit = FakeSubreddit(subreddit)
+        self.is_root = parent is None
+        self._parent = parent
+        self.read = False
+        self.replies = list()
+
+    def parent(self):
+        return self._parent
+
+    def reply(self, body):
+        reply = FakeComment(self.id + '_r', body, author='r2d8', parent=self)
+        self.replies.append(reply)
+        return reply
+
+    def edit(self, body):
+        self.body = body
+        return self
+
+    def mark_read(self):
+        self.read = True
+
+    def mark_unread(self):
+        self.read = False
+
+
+def make_comments(games, count, names_per_comment, rnd):
+    '''Make up inbox comments asking about games. Popular games are asked about more, some
+    names are mangled and some comments link to BGG instead of bolding names.'''
+    weights = [1.0 / (i + 1) for i in range(len(games))]
+    comments = list()
+    for i in range(count):
+        picked = rnd.choices(games, weights=weights, k=names_per_comment)
+        if rnd.random() < 0.2:
+            body = 'u/r2d8 expandurls ' + ' '.join(
+                'https://boardgamegeek.com/boardgame/{}/x'.format(g.id) for g in picked)
+            command = 'expandurls'
+        else:
+            names = list()
+            for g in picked:
+                name = g.name
+                if rnd.random() < 0.1:
+                    name = name.replace('The ', '')
+                elif rnd.random() < 0.05:
+                    name = name + ' typo'
+                names.append('**{}**'.format(name))
+            command = rnd.choice(['getinfo', 'getinfo short', 'getinfo long',
+                                  'getinfo tabular year rank rating'])
+            body = 'u/r2d8 {} {}'.format(command, ' '.join(names))
+        comments.append((command, FakeComment('c{}'.format(i), body)))
+
+    return comments
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+
+def run(args):
+    rnd = random.Random(args.seed)
+    games = load_recordings(args.recordings) if args.recordings else []
+    if not games:
+        games = make_games(args.games, rnd)
+
+    bgg = FakeBGG(games, args.latency / 1000.0)
+    bdb = BotDatabase(':memory:')
+    ch = CommentHandler('r2d8', bdb, lookup_threads=args.lookup_threads, bgg=bgg,
+                        bgg_error=FakeBGGError)
+    comments = make_comments(games, args.comments, args.names, rnd)
+    reddit = FakeReddit([c for _, c in comments])
+
+    handlers = {
+        'getinfo': ch.getInfo,
+        'expandurls': ch.expandURLs
+    }
+    latencies = dict()
+    calls = dict()
+
+    start = perf_counter()
+    bdb.add_comments(InboxStream(reddit, bdb).poll(), reddit.inbox)
+    poll_time = perf_counter() - start
+
+    for command, comment in comments:
+        cmd = command.split()
+        before_calls = bgg.calls
+        before = perf_counter()
+        handlers[cmd[0]](comment, subcommands=cmd[1:], config={})
+        latencies.setdefault(command, []).append(perf_counter() - before)
+        calls.setdefault(command, []).append(bgg.calls - before_calls)
+
+    elapsed = perf_counter() - start
+
+    print('{} comments, {} games, {} names per comment, {}ms BGG latency'.format(
+        args.comments, len(games), args.names, args.latency))
+    print('inbox poll: {:.1f}ms'.format(poll_time * 1000))
+    print('{:<36} {:>6} {:>9} {:>9} {:>9} {:>10}'.format(
+        'command', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'BGG calls'))
+    for command in sorted(latencies):
+        times = latencies[command]
+        print('{:<36} {:>6} {:>9.1f} {:>9.1f} {:>9.1f} {:>10.2f}'.format(
+            command, len(times), percentile(times, 50) * 1000, percentile(times, 90) * 1000,
+            percentile(times, 99) * 1000, sum(calls[command]) / float(len(calls[command]))))
+    print('total BGG calls: {}'.format(bgg.calls))
+    print('throughput: {:.1f} comments/s'.format(args.comments / elapsed))
+    print('game cache: {}'.format(ch.cacheStats()))
+
+
+def check_startup(module='artoodeeeight'):
+    '''Import module in a fresh interpreter. Returns True if it was quick enough and left the
+    SLOW_IMPORTS alone.'''
+    code = ('import sys, time\n'
+            'start = time.perf_counter()\n'
+            'import {}\n'
+            'print(time.perf_counter() - start)\n'
+            'print(" ".join(sorted(sys.modules)))'.format(module))
+    # best of a few runs, the first one also pays for a cold disk cache.
+    runs = [subprocess.run([sys.executable, '-c', code], cwd=dirname(abspath(__file__)),
+                           stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+            for _ in range(3)]
+    elapsed = min(float(out.split('\n')[0]) for out in runs)
+    imported = set(runs[0].split('\n')[1].split())
+    slow = [m for m in SLOW_IMPORTS if m in imported]
+
+    print('import {}: {:.1f}ms, budget {:.0f}ms'.format(module, elapsed * 1000, IMPORT_BUDGET * 1000))
+    if slow:
+        print('imported at startup: {}'.format(', '.join(slow)))
+    return elapsed <= IMPORT_BUDGET and not slow
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Benchmark the bot offline.')
+    ap.add_argument('--comments', help='Number of comments to answer.', default=200, type=int)
+    ap.add_argument('--names', help='Games asked about per comment.', default=10, type=int)
+    ap.add_argument('--games', help='Number of made up games, if no recordings.', default=500,
+                    type=int)
+    ap.add_argument('--recordings', help='Directory of recorded BGG XML responses.', default=None)
+    ap.add_argument('--latency', help='Milliseconds each BGG call takes.', default=20.0,
+                    type=float)
+    ap.add_argument('--lookup-threads', help='Concurrent BGG lookups per request.',
+                    default=CommentHandler.DEFAULT_LOOKUP_THREADS, type=int)
+    ap.add_argument('--seed', help='Random seed, for repeatable runs.', default=8, type=int)
+    ap.add_argument('--startup', help='Check the import time budget instead.', action='store_true')
+    addLoggingArgs(ap)
+    args = ap.parse_args()
+    handleLoggingArgs(args)
+    if args.startup:
+        sys.exit(0 if check_startup() else 1)
+    run(args)
+
+
+if "__main__" == __name__:
+    main()
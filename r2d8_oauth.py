@@ -1,17 +1,16 @@
 import logging
 import configparser 
+from pathlib import Path
 
 log = logging.getLogger(__name__)
 
 default_config_location = "/home/r2d8/.config/praw.ini"
-from pathlib import Path
-
-config_file = Path(default_config_location)
-if not config_file.is_file():
-    print(("Missing praw.ini value with /r/boardgames customized values, stick it in ", default_config_location))
   
 def login(config_file_path = default_config_location):
     import praw
+    if not Path(config_file_path).is_file():
+        print(("Missing praw.ini value with /r/boardgames customized values, stick it in ", config_file_path))
+
     #I'm parsing the config file because praw isn't....  
     config = configparser.ConfigParser()
     config.read(config_file_path)